@@ -1,44 +1,92 @@
+import pyglet
 from pyglet.gl import *
 from pyglet.window import key
 from pyglet import resource, sprite, font, image, graphics, media
+from pyglet.image.atlas import Allocator, AllocatorException
+import sys, time
 
-import rooms
-
-TILE_W, TILE_H = 32, 32
-ROOM_TW, ROOM_TH = 16, 12
-ROOMWIDTH = ROOM_TW * TILE_W
-ROOMHEIGHT = ROOM_TH * TILE_H
-
-# map codes from level editor.
-C_TORCH = 1
-C_ROPE = 2
-C_ENDROPE = 4
-C_SPRING = 5
-C_CRAWLER = 8
-C_BAT = 9
-C_SPIDER = 12
-C_SPIDERTOP = 10
-C_BLOCKER = 16
-
-# tile classes.
-SOLID = (2,3,4,5,12,13,18,19,34,35)
-CLIMBABLE = (8,10)
-SUPPORTS = SOLID + CLIMBABLE
-DAMAGE = (1,9,26)
-
-# gameplay mechanics.
-SPEED = 180
-JUMP_FORCE = 4.9
-GRAVITY = 10
+import world
+import sim
+from profiler import PhaseProfiler
+from hitches import HitchDetector, LOGFILE as HITCH_LOG
+from latency import RoomChanges
+
+# main loop pacing.
+TARGET_FPS = 60 # frame cap when vsync is not pacing the loop.
+BLACKOUT = 0.25 # seconds to hide the screen when changing rooms.
 
 # room display names.
 NAMES = {
     (0,0): "The Great Hall",
 }
 
+# images packed into the texture atlas: filename, frame width, frame height.
+SHEETS = (
+    ("tiles.png", 32, 32),
+    ("belle.png", 32, 48),
+    ("crawler.png", 32, 32),
+    ("bat.png", 32, 32),
+    ("spider.png", 32, 32),
+    ("flame.png", 32, 32),
+    ("spring.png", 32, 32),
+    ("rope.png", 8, 32),
+    ("sliver.png", 2, 32),
+    ("health.png", 207, 15),
+)
+
+
+class Atlas(object):
+    """All sprite sheets packed into a single texture."""
+
+    def __init__(self):
+        self.texture = None
+        self.images = {} # filename -> atlas region.
+        self.frames = {} # (filename, index) -> atlas region.
+        self.counts = {} # filename -> frames in its sheet.
+
+    def load(self, sheets, renderer):
+        """Pack sheets into the smallest square texture that fits them."""
+        imgs = [(pyglet.image.load(name, file=pyglet.resource.file(name)), name)
+                    for name,tw,th in sheets]
+        # the allocator packs best in decreasing height order.
+        imgs.sort(key=lambda item: item[0].height, reverse=True)
+        size = 256
+        while True:
+            alloc = Allocator(size, size)
+            try:
+                # leave a one pixel gap to avoid filtering bleed.
+                places = [alloc.alloc(img.width+1, img.height+1) for img,name in imgs]
+                break
+            except AllocatorException:
+                size *= 2
+        self.texture = renderer.createTexture(size, size)
+        for (img,name),(x,y) in zip(imgs, places):
+            renderer.upload(self.texture, img, x, y)
+            self.images[name] = self.texture.get_region(x, y, img.width, img.height)
+        for name,tw,th in sheets:
+            tiles = loadTiles(name, tw, th)
+            self.counts[name] = len(tiles)
+            for i,t in enumerate(tiles):
+                self.frames[(name,i)] = t
+
+    def image(self, filename):
+        """Get the atlas region holding a whole image."""
+        return self.images[filename]
+
+    def frame(self, filename, index):
+        """Get a frame of a sprite sheet."""
+        return self.frames[(filename,index)]
+
+    def sheet(self, filename):
+        """Get all the frames of a sprite sheet, in order."""
+        return [self.frames[(filename,i)] for i in xrange(self.counts[filename])]
+
+atlas = Atlas()
+
+
 def loadTiles(filename, tw, th):
     """Make a list of tiles from a tile sheet image"""
-    img = pyglet.resource.image(filename)
+    img = atlas.image(filename)
     w,h = img.width, img.height
     numx,numy = w/tw, h/th
     return [img.get_region(x,h-y-th,tw,th)
@@ -59,21 +107,122 @@ def xcenterTiles(tiles):
         t.anchor_x = t.width//2
     return tiles
 
+
+class AssetCache(object):
+    """Frame lists and animations shared by every spawned actor."""
+
+    def __init__(self):
+        self.entries = {}
+        self.hits, self.misses = 0, 0
+        self.listener = None # called with ("asset", filename) on a miss.
+
+    def get(self, key, factory):
+        """Get a cached value, calling factory to make it on a miss."""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            if self.listener:
+                self.listener("asset", key[0])
+            value = self.entries[key] = factory()
+        else:
+            self.hits += 1
+        return value
+
+    def tiles(self, filename, flip=False):
+        """Cached frames of a packed sheet, optionally x-flipped."""
+        if flip:
+            return self.get((filename, True),
+                lambda: makeFlipped(self.tiles(filename)))
+        return self.get((filename, False), lambda: atlas.sheet(filename))
+
+    def animation(self, filename, period, indices=None, flip=False):
+        """Cached looping frame table over some frames of a sheet.
+        flip may be a tuple to choose flipping for each index."""
+        def make():
+            plain = self.tiles(filename)
+            flipped = self.tiles(filename, True)
+            nums = indices or range(len(plain))
+            flips = flip if isinstance(flip, tuple) else (flip,) * len(nums)
+            seq = [(flipped if f else plain)[n] for n,f in zip(nums, flips)]
+            return FrameTable(seq, period)
+        return self.get((filename, flip, period, indices), make)
+
+    def preload(self, views):
+        """Build frames for simulated classes ahead of their first spawn."""
+        for cls,(viewclass,filename,loader) in views.items():
+            if loader:
+                self.get((filename, cls), loader)
+
+    def evict(self, filename=None):
+        """Drop cached frames for one image, or everything."""
+        if filename is None:
+            self.entries.clear()
+        else:
+            for key in self.entries.keys():
+                if key[0] == filename:
+                    del self.entries[key]
+
+assets = AssetCache()
+
+
+class FrameTable(object):
+    """Looping animation frames, shared by every sprite that shows them."""
+
+    def __init__(self, frames, period):
+        self.frames = frames
+        self.period = period # seconds per frame.
+
+
+class Animator(object):
+    """Moves every animated sprite through its frame table in one pass
+    per update, instead of one pyglet clock event per sprite per frame."""
+
+    def __init__(self):
+        self.time = 0.0
+        self.active = set() # sprites showing a frame table.
+
+    def start(self, s, table):
+        """Show a frame table on a sprite from its first frame."""
+        s.table, s.started, s.index = table, self.time, 0
+        s.image = table.frames[0]
+        self.active.add(s)
+
+    def stop(self, s):
+        self.active.discard(s)
+        s.table = None
+
+    def tick(self, dt):
+        self.time = t = self.time + dt
+        for s in self.active:
+            table = s.table
+            index = int((t - s.started) / table.period) % len(table.frames)
+            if index != s.index:
+                s.index = index
+                s.image = table.frames[index]
+
+animator = Animator()
+
 def drawRope(tex, height, x, y):
-    """Draw a rope by repeating a texture."""
+    """Draw a rope by stacking copies of a texture region downwards."""
     if height > 0:
-        tv = height / float(tex.height)
+        tc = tex.tex_coords
+        u0,v0,u1,v1 = tc[0],tc[1],tc[3],tc[7]
+        tw,th = tex.width, tex.height
         glEnable(tex.target)
         glBindTexture(tex.target, tex.id)
         glBegin(GL_QUADS)
-        glTexCoord2f(0, 0)
-        glVertex3f(x, y, 0)
-        glTexCoord2f(0, -tv)
-        glVertex3f(x, y - height, 0)
-        glTexCoord2f(1, -tv)
-        glVertex3f(x + tex.width, y - height, 0)
-        glTexCoord2f(1, 0)
-        glVertex3f(x + tex.width, y, 0)
+        while height > 0:
+            h = min(height, th)
+            vb = v1 - (v1-v0) * h / float(th) # clip the last copy.
+            glTexCoord2f(u0, v1)
+            glVertex3f(x, y, 0)
+            glTexCoord2f(u0, vb)
+            glVertex3f(x, y - h, 0)
+            glTexCoord2f(u1, vb)
+            glVertex3f(x + tw, y - h, 0)
+            glTexCoord2f(u1, v1)
+            glVertex3f(x + tw, y, 0)
+            y -= h ; height -= h
         glEnd()
         glDisable(tex.target)
 
@@ -96,11 +245,120 @@ def fillRect(x,y,w,h,r,g,b,a=1):
     glColor4f(1,1,1,1)
 
 
+class GLRenderer(object):
+    """Draws with OpenGL. Everything on screen goes through a renderer,
+    so drawing can be swapped for CountingRenderer."""
+
+    def createTexture(self, width, height):
+        return image.Texture.create(width, height, GL_RGBA)
+
+    def upload(self, texture, img, x, y):
+        texture.blit_into(img, x, y, 0)
+
+    def beginFrame(self, window):
+        window.clear()
+        glLoadIdentity()
+
+    def endFrame(self):
+        pass
+
+    def push(self, x, y):
+        glPushMatrix()
+        glTranslatef(x, y, 0)
+
+    def pop(self):
+        glPopMatrix()
+
+    def tiles(self, layer):
+        layer.batch.draw()
+
+    def sprite(self, s):
+        sprite.Sprite.draw(s)
+
+    def rope(self, tex, height, x, y):
+        drawRope(tex, height, x, y)
+
+    def rect(self, x, y, w, h, r, g, b, a=1):
+        fillRect(x, y, w, h, r, g, b, a)
+
+    def text(self, t):
+        t.draw()
+
+
+class CountingRenderer(object):
+    """Draws nothing, but counts the GL work each frame would do.
+    Needs no GL context, so drawing can be measured on any machine."""
+
+    COUNTERS = ("draws", "binds", "vertices", "states")
+
+    def __init__(self):
+        self.textures = 0 # stand-in texture ids handed out.
+        self.frames = 0
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.frame = dict.fromkeys(self.COUNTERS, 0)
+        self.bound = None # texture id of the last bind.
+
+    def createTexture(self, width, height):
+        self.textures += 1
+        return image.Texture(width, height, GL_TEXTURE_2D, self.textures)
+
+    def upload(self, texture, img, x, y):
+        pass
+
+    def count(self, draws, vertices, states, texture=None):
+        frame = self.frame
+        frame["draws"] += draws
+        frame["vertices"] += vertices
+        frame["states"] += states
+        # binding the texture that is already bound costs next to nothing.
+        if texture is not None and texture.id != self.bound:
+            frame["binds"] += 1
+            self.bound = texture.id
+
+    def beginFrame(self, window=None):
+        self.frame = dict.fromkeys(self.COUNTERS, 0)
+        self.bound = None
+        self.count(0, 0, 2) # clear, load identity.
+
+    def endFrame(self):
+        """Add the frame to the totals; returns its counters."""
+        self.frames += 1
+        for name,value in self.frame.items():
+            self.totals[name] += value
+        return self.frame
+
+    def push(self, x, y):
+        self.count(0, 0, 2)
+
+    def pop(self):
+        self.count(0, 0, 1)
+
+    def tiles(self, layer):
+        if layer.vertices:
+            self.count(1, layer.vertices, 2, layer.texture)
+
+    def sprite(self, s):
+        # sprites set and restore blending and texture state each draw.
+        self.count(1, 4, 4, s._texture)
+
+    def rope(self, tex, height, x, y):
+        if height > 0:
+            copies = (int(height) + tex.height - 1) // tex.height
+            self.count(1, 4*copies, 2, tex)
+
+    def rect(self, x, y, w, h, r, g, b, a=1):
+        self.count(1, 4, 2)
+
+    def text(self, t):
+        self.count(1, 0, 0)
+
+
 class TileSet(object):
     """A set of regular sized tile images."""
 
     def __init__(self, filename, tw, th, dw, dh):
         self.tiles = []
+        self.texture = None
         self.tilewidth, self.tileheight = tw,th
         self.drawwidth, self.drawheight = dw, dh
         if filename:
@@ -109,7 +367,8 @@ class TileSet(object):
     def load(self, filename, tw, th):
         """Load tiles from a packed tile sheet."""
         self.tilewidth, self.tileheight = tw,th
-        img = pyglet.resource.image(filename)
+        img = atlas.image(filename)
+        self.texture = atlas.texture
         w,h = img.width, img.height
         numx,numy = w/tw, h/th
         self.tiles = [
@@ -126,576 +385,345 @@ class TileSet(object):
             if x>=32*8: x=0 ; y=y+32
 
 
-class Room(object):
-    """A tile-based game room."""
-
-    x,y = 0,0
-    mapwidth,mapheight = 1,1
-    tilewidth,tileheight = 1,1
-    bounce = 0 # displacement due to falling damage.
-
-    def __init__(self, tileset, x, y, specials={}, codemap={}):
-        self.tileset = tileset
-        self.tilewidth, self.tileheight = tileset.drawwidth, tileset.drawheight
-        self.x, self.y = x,y
-        self.specials = specials
-        self.codemap = codemap
-        self.tiles = [] # private copy.
-        self.codes = [] # shared, original room data.
-        self.tilemap = [] # shared, original room data.
-        self.colmap = [] # derived collision map.
-        self.background = []
-        self.sprites = []
-
-    def draw(self):
-        tiles = self.tiles
-        numx,numy = len(tiles[0]), len(tiles)
-        tw,th = self.tilewidth, self.tileheight
-        posy = th * numy - th # start at the top.
-        for y in xrange(0,numy):
-            posx = 0
-            row = tiles[y]
-            for x in xrange(0,numx):
-                t = row[x]
-                if t:
-                    t.blit(posx,posy,0)
-                posx += tw
-            posy -= th
-        # draw sprite layers.
-        for obj in self.background: obj.draw()
-        for obj in self.sprites: obj.draw()
-
-    def load(self, room, codes, objs):
-        """Load a room and convert for rendering; spawn sprites."""
-        self.background = []
-        self.sprites = []
-        w,h = len(room[0]), len(room)
-        self.mapwidth, self.mapheight = w,h
-        self.tiles = tiles = [[None for x in xrange(0,w)] for y in xrange(0,h)]
-        self.colmap = colmap = [[0 for x in xrange(0,w)] for y in xrange(0,h)]
-        self.tilemap = room # for tileTest.
-        self.codes = codes # must set before calling factories.
-        ts = self.tileset.tiles
-        tw,th = self.tilewidth, self.tileheight
+class TileLayer(object):
+    """The tile layer of a prepared room as a single vertex list."""
+
+    def __init__(self, tileset, group, data):
+        self.batch = graphics.Batch()
+        self.vlist = None
+        self.texture = tileset.texture
+        self.vertices = 0
+        ts = tileset.tiles
+        tw,th = tileset.drawwidth, tileset.drawheight
+        w,h = data.width, data.height
         top = th * h - th # origin of top tile.
-        specials, codemap = self.specials, self.codemap
+        verts, coords = [], []
         for y in xrange(0,h):
             for x in xrange(0,w):
-                num = room[y][x]
-                tiles[y][x] = ts[num]
-                if num in SOLID:
-                    colmap[y][x] = 1
-                code = codes[y][x]
-                factory = codemap.get(code)
-                if factory:
-                    objs.append(factory(x*tw, top-y*th, self))
-
-    def hitTest(self, x0, y0, x1, y1, check):
-        """Hit-test a rectangle against solid map tiles."""
-        tmap = self.tilemap
-        ew,eh = len(tmap[0])-1,len(tmap)-1
-        tx0 = max(0,x0//TILE_W)
-        ty0 = max(0,y0//TILE_H)
-        tx1 = min(ew,x1//TILE_W)
-        ty1 = min(eh,y1//TILE_H)
-        ty0,ty1 = eh-ty1,eh-ty0 # invert Y axis.
-        for ty in xrange(ty0,ty1+1):
-            row = tmap[ty]
-            for tx in xrange(tx0,tx1+1):
-                tile = row[tx]
-                if tile in check:
-                    return True, tx, eh-ty, tile
-        return False, 0, 0, 0
-
-    def tileTest(self, x, y, w, h, check):
-        """Hit-test against the room tile layer."""
-        tmap = self.tilemap
-        ew,eh = len(tmap[0])-1,len(tmap)-1
-        tx0 = max(0,x//TILE_W)
-        ty0 = max(0,y//TILE_H)
-        tx1 = min(ew,(x+w)//TILE_W)
-        ty1 = min(eh,(y+h)//TILE_H)
-        ty0,ty1 = eh-ty1,eh-ty0 # invert Y axis.
-        for ty in xrange(ty0,ty1+1):
-            row = tmap[ty]
-            for tx in xrange(tx0,tx1+1):
-                tile = row[tx]
-                if tile in check:
-                    return True, tx, eh-ty, tile
-        return False, 0, 0, 0
-
-    def scanForCode(self, x, y, dx, dy, code):
-        """Scan the code layer in direction dx,dy for a value."""
-        codes = self.codes
-        cw,ch = len(codes[0]), len(codes)
-        tw,th = self.tilewidth, self.tileheight
-        top = th * ch - th # origin of top tile.
-        cx,cy = x//tw, (top-y)//th # room coords to map cell.
-        while cx>=0 and cy >=0 and cx<cw and cy<ch:
-            if codes[cy][cx] == code:
-                break
-            cx += dx ; cy += dy
-        return (cx*tw,top-cy*th) # map cell to room coords.
-
-
-class Actor(sprite.Sprite):
-    """Animated actor with tile collisions."""
-
-    def __init__(self, frames, x, y, group=None):
+                num = ord(data.tilemap[y*w+x])
+                if num: # tile 0 is blank.
+                    px,py = x*tw, top-y*th
+                    verts.extend((px,py, px+tw,py, px+tw,py+th, px,py+th))
+                    coords.extend(ts[num].tex_coords)
+        if verts:
+            self.vertices = len(verts)//2
+            self.vlist = self.batch.add(self.vertices, GL_QUADS, group,
+                                        ('v2i', verts), ('t3f', coords))
+
+    def draw(self, renderer):
+        renderer.tiles(self)
+
+    def memory(self):
+        """Rough bytes held: v2i and t3f per vertex, plus the batch."""
+        return 20 * self.vertices + 512
+
+    def delete(self):
+        """Release the vertex list."""
+        if self.vlist:
+            self.vlist.delete()
+            self.vlist = None
+
+
+# the renderer draws sprites one at a time, so this batch is never drawn;
+# it keeps them off pyglet's default batch, which needs a GL context.
+spriteBatch = graphics.Batch()
+
+class ActorView(sprite.Sprite):
+    """Draws a simulated actor using its current frame, which may be an
+    image or a FrameTable for the animator to step through."""
+
+    table = None # frame table the animator is showing, if any.
+
+    def __init__(self, actor, frames):
+        self.actor = actor
         self.frames = frames
-        sprite.Sprite.__init__(self, frames[0], x, y)
-
-    def setFrame(self, index):
-        if index < len(self.frames):
-            frame = self.frames[index]
-            if self.image is not frame: # avoid animation reset.
-                self.image = frame
-
-    def hitTest(self, x, y, w, h):
-        """Conservative hit test for player collisions."""
-        mx,my,mw,mh = self.x+4,self.y+4,self.width-8,self.height-8
-        return x<mx+mw and x+w>mx and y<my+mh and y+h>my
-
-
-class Player(Actor):
-
-    velocity = 0
-    anim = 0
-    defecit = 0
-    health = 100
-    support = None # sprite we are standing on.
-
-    def __init__(self, x, y, room):
-        self.room = room
-        tiles = loadTiles("belle.png", 32, 48)
-        flipped = makeFlipped(tiles)
-        right = [tiles[n] for n in (1,2,3,2)]
-        left = [flipped[n] for n in (1,2,3,2)]
-        climb = [tiles[5], flipped[5]]
-        frames = [
-            image.Animation.from_image_sequence(right, 12/60.0, True),
-            image.Animation.from_image_sequence(left, 12/60.0, True),
-            image.Animation.from_image_sequence(climb, 8/60.0, True),
-            tiles[0], flipped[0], climb[0], # stationary
-            tiles[4], flipped[4], climb[0], # jumping
-        ]
-        Actor.__init__(self, frames, x, y)
-        self.jump_snd = pyglet.resource.media("jump.wav", streaming=False)
-
-    def move(self, dx, dy, jump, dt):
-        """Process player input."""
-        w,h = 32,32
-        ox,rw,rh = 2,w-4-1,h-1 # smaller collision rect.
-
-        oldx,oldy = int(self.x),int(self.y)
-        moved = False
-
-        # issues:
-        # - when falling onto a climbable tile, the player falls inside
-        #   the tile by whatever velocity they have at impact.
-        # - bouncing at tops of ladders.
-        # - climbable means both up and down at once.
-
-        # test for climbable tiles or sprites in contact with the player.
-        # note we do not look below the player's feet here, we do that later.
-        qx,qy = oldx + ox, oldy
-        canClimb,hx,hy,tn = self.room.tileTest(qx, qy-1, rw, rh+1, CLIMBABLE)
-        if not canClimb:
-            # test only background sprites; ropes.
-            for obj in self.room.background:
-                if getattr(obj, "climbable", 0):
-                    if obj.hitTest(qx, qy, rw, rh):
-                        canClimb = True
-                        break
-
-        # accumulate move adjustments until we move at least one pixel,
-        # then hittest the area covered by the integer movement.
-        adjx = self.x + SPEED*dx
-        newx = int(adjx)
-        if newx > oldx: # moving right.
-            hit,hx,hy,tc = self.room.hitTest(oldx+ox+rw, oldy, newx+ox+rw, oldy+rh, SOLID)
-            self.x = hx*TILE_W-(rw+1)-ox if hit else adjx
-            self.anim = 0
-            moved = True
-        elif newx < oldx: # moving left.
-            hit,hx,hy,tc = self.room.hitTest(newx+ox, oldy, oldx+ox, oldy+rh, SOLID)
-            self.x = (hx+1)*TILE_W-ox if hit else adjx
-            self.anim = 1
-            moved = True
-        else:
-            self.x = adjx # accumulate movement.
-
-        # determine vertical movement.
-        support = self.support
-        climbed = False
-        adjy = self.y
-        if canClimb:
-            # allow the player to climb.
-            if dy != 0:
-                adjy = self.y + SPEED*dy
-                self.anim = 2
-                moved = True
-                climbed = True
-                self.stopFalling() # stop jumping or falling.
-            else:
-                # allow jumping but not falling.
-                self.velocity += dt * -GRAVITY
-                if self.velocity > 0:
-                    adjy = self.y + self.velocity
+        self.shown = None # the entry of frames being shown.
+        first = frames[0]
+        if isinstance(first, FrameTable):
+            first = first.frames[0]
+        sprite.Sprite.__init__(self, first, actor.x, actor.y, batch=spriteBatch)
+
+    def draw(self, renderer, alpha=1.0):
+        """Draw between the positions of the last two logic ticks."""
+        a = self.actor
+        if a.frame < len(self.frames):
+            frame = self.frames[a.frame]
+            if frame is not self.shown: # avoid animation reset.
+                self.shown = frame
+                if isinstance(frame, FrameTable):
+                    animator.start(self, frame)
                 else:
-                    self.stopFalling()
-        else:
-            # apply gravity.
-            self.velocity += dt * -GRAVITY
-            adjy = self.y + self.velocity
-
-        # apply vertical movement unless on a support sprite.
-        supported = canClimb
-        newy = int(adjy)
-        newx = int(self.x) + ox
-        if newy > oldy: # moving up.
-            support = None # climbed off support.
-            hit,hx,hy,tc = self.room.hitTest(newx, oldy+rh, newx+rw, newy+rh, SOLID)
-            if hit:
-                self.y = hy*TILE_H-(rh+1)
-                if self.velocity > 0:
-                    self.velocity = 0 # stop upward velocity.
-            else:
-                self.y = adjy
-        elif newy < oldy: # moving down.
-            support = None # moved off support.
-            hit,hx,hy,tc = self.room.hitTest(newx, newy, newx+rw, oldy, SOLID)
-            if hit:
-                self.y = (hy+1)*TILE_H
-                supported = True
-                self.stopFalling()
-            else:
-                # would fall: check for a supporting sprite below us.
-                qh = oldy - newy
-                for obj in self.room.background:
-                    if getattr(obj, "supports", 0):
-                        if obj.hitTest(newx, newy, rw, qh):
-                            if support is None or obj.y + obj.level > support.y + support.level:
-                                support = obj
-                if support is None:
-                    # no support: free fall.
-                    self.y = adjy
-        else:
-            self.y = adjy # accumulate movement.
-
-        if support is not None:
-            supported = True
-
-        # check for jump input if standing on something.
-        # avoid jumping while climbing since it spam-jumps every frame!
-        # velocity <=0 avoids spam-jumping when jumping up ladders.
-        # TODO: still spam-jumps when something is above your head.
-        if jump and supported and not climbed and self.velocity <= 0:
-            self.velocity = JUMP_FORCE
-            if support is not None:
-                func = getattr(support, "actorJump", None)
-                if func: func(self)
-            self.jump_snd.play()
-            support = None # jumped off support.
-
-        # notify supports if our support has changed.
-        if support is not self.support:
-            #print "CHANGED SUPPORT"
-            # notify our old support, if any.
-            func = getattr(self.support, "lostActor", None)
-            if func: func(self)
-            # notify our new support.
-            self.support = support
-            func = getattr(support, "gainActor", None)
-            if func: func(self)
-
-        # this must deal with actor position and velocity.
-        if support is not None:
-            support.supportActor(self)
-
-        if self.velocity != 0:
-            # show a jump/fall frame.
-            self.setFrame(self.anim + 6)
-        elif moved and supported:
-            # show animated walk or climb.
-            self.setFrame(self.anim)
-        else:
-            # show an idle frame.
-            self.setFrame(self.anim + 3)
-
-    def stopFalling(self):
-        if self.velocity < -8:
-            # take falling damage.
-            damage = (-self.velocity-8)*3
-            #print "DAMAGE", damage, self.velocity
-            self.defecit += damage
-            self.room.bounce = min(int(damage/2),4) # limit to 4.
-        self.velocity = 0
-
-    def update(self, dt):
-        pass
-
-    def checkDamage(self):
-        # conservative collision rect for the player.
-        qx,qy,rw,rh = int(self.x) + 6, int(self.y), 32-12, 28
-        damage,hx,hy,tn = self.room.tileTest(qx, qy, rw, rh, DAMAGE)
-        if not damage:
-            # hit-test all enemy sprites.
-            for obj in self.room.sprites:
-                if getattr(obj, "hurtful", 0):
-                    if obj.hitTest(qx, qy, rw, rh):
-                        damage = True
-                        break
-        if damage:
-            self.defecit += 1
-
-
-class Torch(sprite.Sprite):
-    """Animated torch fixture."""
-    def __init__(self, x, y, room):
-        tiles = loadTiles("flame.png", 32, 32)
-        frames = image.Animation.from_image_sequence(tiles, 0.2, True)
-        sprite.Sprite.__init__(self, frames, x, y)
-        room.background.append(self)
-    def update(self, dt):
-        pass
-
-
-class DropRope(object):
-    """Rope that moves up and down."""
+                    animator.stop(self)
+                    self.image = frame
+        self.set_position(a.x + (a.lastx - a.x) * (1 - alpha),
+                          a.y + (a.lasty - a.y) * (1 - alpha))
+        renderer.sprite(self)
 
-    height = 0
-    rate = SPEED*2/3
-    LEFT = 14 # position inside the tile.
-    climbable = True
+    def release(self):
+        """Stop animating while the actor waits in its room's pool;
+        the next draw starts the animation again."""
+        animator.stop(self)
+        self.shown = None
 
-    def __init__(self, x, y, room):
-        ex,ey = room.scanForCode(x,y,0,1,C_ENDROPE)
-        y += TILE_H # start from top edge of tile.
-        self.limit = y - ey
-        self.texture = pyglet.resource.texture("rope.png")
-        self.x, self.y = self.LEFT + x, y
-        self.width = self.texture.width
-        room.background.append(self)
 
-    def update(self, dt):
-        self.height += self.rate * dt
-        if self.height > self.limit:
-            self.height = self.limit
-            self.rate = -self.rate
-        elif self.height < 0:
-            self.height = 0
-            self.rate = -self.rate
-
-    def draw(self):
-        drawRope(self.texture, self.height, self.x, self.y)
+class SpiderView(ActorView):
+    """Draws a spider and the sliver of web above it."""
 
-    def hitTest(self, x, y, w, h):
-        """Exact hit test with fix for reversed y coordinate"""
-        mx,my,mw,mh = self.x,self.y-self.height,self.width,self.height
-        return x<mx+mw and x+w>mx and y<my+mh and y+h>my
+    def draw(self, renderer, alpha=1.0):
+        ActorView.draw(self, renderer, alpha)
+        a = self.actor
+        x,y = a.x + a.LEFT, a.top + sim.TILE_H
+        sy = a.y + (a.lasty - a.y) * (1 - alpha)
+        renderer.rope(atlas.image("sliver.png"), a.top - sy, x, y)
 
 
-class SpringBoard(sprite.Sprite):
-    """A bouncy platform on a spring."""
+class RopeView(object):
+    """Draws a drop rope at its current length."""
 
-    supports = True
-    maxLevel = 24
-    level = maxLevel # support height level.
-    kinetic = 0
+    def __init__(self, rope):
+        self.rope = rope
+        self.texture = atlas.image("rope.png")
 
-    def __init__(self, x, y, room):
-        self.frames = loadTiles("spring.png", 32, 32)
-        sprite.Sprite.__init__(self, self.frames[0], x, y)
-        room.background.append(self)
+    def draw(self, renderer, alpha=1.0):
+        r = self.rope
+        height = r.height + (r.lastheight - r.height) * (1 - alpha)
+        renderer.rope(self.texture, height, r.x, r.y)
 
-    def update(self, dt):
-        """Drain away kinetic energy."""
-        if self.kinetic > 0:
-            self.kinetic -= 5*dt
-            if self.kinetic < 0: self.kinetic = 0
-        steps = min(int(self.kinetic), 3) # limit 3
-        self.image = self.frames[steps]
-        self.level = self.maxLevel - steps * 4
-        #print "KSL", self.kinetic, steps, self.level
-
-    def supportActor(self, other):
-        """Reposition the actor and clear velocity."""
-        other.y = self.y + self.level
-        other.velocity = 0
-
-    def actorJump(self, other):
-        """Boost the jump using our kinetic energy."""
-        other.velocity += self.kinetic
-        self.kinetic = 0
-        self.update(0)
-
-    def gainActor(self, other):
-        """Notify that an actor has landed on us."""
-        if other.velocity < 0:
-            force = int(-other.velocity-2)
-            self.kinetic += force
-            self.update(0)
-            other.velocity = 0 # soak up velocity.
-
-    def hitTest(self, x, y, w, h):
-        """Hit-test against the current spring level."""
-        mx,my,mw,mh = self.x+8,self.y,self.width-12,self.level
-        return x<mx+mw and x+w>mx and y<my+mh and y+h>my
-
-
-class HorzEnemy(Actor):
-    """Enemy that moves horizontally between blocker codes."""
-
-    FILENAME = ""
-    FRAME_W,FRAME_H = 32,32
-    ANIM = False
-    rate = -SPEED*2/3 # initially moving left.
-
-    def __init__(self, x, y, room):
-        sx,sy = room.scanForCode(x, y, -1, 0, C_BLOCKER)
-        ex,ey = room.scanForCode(x, y, 1, 0, C_BLOCKER)
-        # adjust to avoid entering the blocker tiles.
-        self.left, self.right = sx + TILE_W, ex - TILE_W
-        tiles = loadTiles(self.FILENAME, self.FRAME_W, self.FRAME_H)
-        flipped = makeFlipped(tiles)
-        if self.ANIM:
-            tiles = [
-                image.Animation.from_image_sequence(tiles, 0.25, True),
-                image.Animation.from_image_sequence(flipped, 0.25, True),
-            ]
-        else:
-            tiles.extend(flipped)
-        Actor.__init__(self, tiles, x, y)
-        room.sprites.append(self)
+    def release(self):
+        pass
 
-    def update(self, dt):
-        self.x += self.rate * dt
-        if self.x > self.right:
-            self.x = self.right
-            self.rate = -self.rate
-            self.setFrame(0)
-        elif self.x < self.left:
-            self.x = self.left
-            self.rate = -self.rate
-            self.setFrame(1)
-
-
-class Crawler(HorzEnemy):
-    """Crawls along the ground."""
-    FILENAME = "crawler.png"
-    hurtful = True
-
-
-class Bat(HorzEnemy):
-    """Flies left and right."""
-    FILENAME = "bat.png"
-    ANIM = True
-    hurtful = True
-
-
-class Spider(Actor):
-    """Moves up and down on a sliver of web."""
-    rate = SPEED/3 # initially moving down.
-    LEFT = 14 # position of web inside the tile.
-    hurtful = True
-
-    def __init__(self, x, y, room):
-        sx,sy = room.scanForCode(x, y, 0, -1, C_SPIDERTOP)
-        self.top, self.bottom = sy, y
-        y = sy # start at the top.
-        self.texture = pyglet.resource.texture("sliver.png")
-        tiles = loadTiles("spider.png", 32, 32)
-        anim = image.Animation.from_image_sequence(tiles, 12/60.0, True)
-        Actor.__init__(self, [anim], x, y)
-        room.sprites.append(self)
 
-    def update(self, dt):
-        self.y += self.rate * dt
-        if self.y > self.top:
-            self.y = self.top
-            self.rate = -self.rate
-        elif self.y < self.bottom:
-            self.y = self.bottom
-            self.rate = -self.rate
-
-    def draw(self):
-        Actor.draw(self)
-        x,y = self.x + self.LEFT, self.top + TILE_H
-        drawRope(self.texture, self.top - self.y, x, y)
-
-
-codemap = {
-    C_TORCH:    Torch,
-    C_ROPE:     DropRope,
-    C_SPRING:   SpringBoard,
-    C_CRAWLER:  Crawler,
-    C_BAT:      Bat,
-    C_SPIDER:   Spider,
+def playerFrames():
+    tiles = assets.tiles("belle.png")
+    flipped = assets.tiles("belle.png", True)
+    walk = (1,2,3,2)
+    return [
+        assets.animation("belle.png", 12/60.0, walk),
+        assets.animation("belle.png", 12/60.0, walk, True),
+        assets.animation("belle.png", 8/60.0, (5,5), (False,True)),
+        tiles[0], flipped[0], tiles[5], # stationary
+        tiles[4], flipped[4], tiles[5], # jumping
+    ]
+
+def enemyFrames(filename, anim):
+    """Left and right facing frames for a horizontal enemy."""
+    if anim:
+        return [assets.animation(filename, 0.25),
+                assets.animation(filename, 0.25, flip=True)]
+    return assets.tiles(filename) + assets.tiles(filename, True)
+
+# simulated class -> view class, image, frames loader.
+VIEWS = {
+    sim.Player:      (ActorView, "belle.png", playerFrames),
+    sim.Torch:       (ActorView, "flame.png",
+                        lambda: [assets.animation("flame.png", 0.2)]),
+    sim.DropRope:    (RopeView, "rope.png", None),
+    sim.SpringBoard: (ActorView, "spring.png",
+                        lambda: assets.tiles("spring.png")),
+    sim.Crawler:     (ActorView, "crawler.png",
+                        lambda: enemyFrames("crawler.png", False)),
+    sim.Bat:         (ActorView, "bat.png", lambda: enemyFrames("bat.png", True)),
+    sim.Spider:      (SpiderView, "spider.png",
+                        lambda: [assets.animation("spider.png", 12/60.0)]),
 }
 
+def makeView(obj):
+    """Make the view that draws a simulated object."""
+    cls = obj.__class__
+    viewclass, filename, loader = VIEWS[cls]
+    if loader:
+        return viewclass(obj, assets.get((filename, cls), loader))
+    return viewclass(obj)
+
+def drawRoom(renderer, room, player, alpha=1.0):
+    """Draw a room's tiles and actors, then the player."""
+    # the whole tile layer is one vertex list.
+    data = room.data
+    if data and data.view:
+        data.view.draw(renderer)
+    # draw sprite layers.
+    for obj in room.background: obj.view.draw(renderer, alpha)
+    for obj in room.sprites: obj.view.draw(renderer, alpha)
+    player.view.draw(renderer, alpha)
+
+
+class RoomViews(sim.Simulation):
+    """Simulation that keeps what draws it: a tile layer for each
+    prepared room and a view for each actor, reused across rooms."""
+
+    def __init__(self, world, tileset, **options):
+        self.ts = tileset
+        self.group = graphics.TextureGroup(tileset.texture)
+        sim.Simulation.__init__(self, world, **options)
+
+    def roomData(self, roomX, roomY):
+        """Get prepared state for a room, with its tile layer."""
+        data = sim.Simulation.roomData(self, roomX, roomY)
+        if data.view is None:
+            self.note("upload", "tiles %d,%d" % (roomX, roomY))
+            data.view = TileLayer(self.ts, self.group, data)
+        return data
 
-class Game(object):
-    """The game controller."""
-
-    def __init__(self, window):
-        """Set up the game state."""
+    def loadRoom(self, roomX, roomY):
+        # old actors are pooled with their sprites; stop their clocks.
+        for obj in self.objs:
+            if obj is not self.player and obj.view:
+                obj.view.release()
+        sim.Simulation.loadRoom(self, roomX, roomY)
+        made = 0
+        for obj in self.objs:
+            if obj.view is None:
+                obj.view = makeView(obj)
+                made += 1
+        self.note("sprites", "%d, %d new" % (len(self.objs), made))
+
+
+class Game(RoomViews):
+    """The game controller: draws the simulation and feeds it input."""
+
+    def __init__(self, window, fps=TARGET_FPS, lazyMenu=True, blackout=BLACKOUT,
+                 renderer=None, profiler=None, hitches=None, cache=sim.ROOM_CACHE_BYTES,
+                 roomChanges=None):
+        """Set up the game state.
+        fps caps the frame rate unless vsync is on; 0 runs uncapped.
+        lazyMenu redraws the title menu only after input.
+        blackout hides the screen for that long on a room change.
+        renderer does the drawing; a GLRenderer by default.
+        profiler times the phases of each frame; F3 shows it.
+        hitches records slow frames while playing.
+        roomChanges times room changes from edge to reveal.
+        cache is the memory budget in bytes for prepared rooms."""
         self.window = window
+        self.renderer = renderer or GLRenderer()
+        self.profiler = profiler or PhaseProfiler(1.0 / (fps or TARGET_FPS))
+        self.lap = self.profiler.lap
+        self.hitches = hitches or HitchDetector(2.0 / (fps or TARGET_FPS), None)
+        self.note = self.hitches.note
+        self.roomChanges = roomChanges or RoomChanges()
+        self.showProfile = False
+        self.profileText = []
+        self.profileDue = 0 # time to refresh the profile overlay.
+        self.fps = fps
+        self.lazyMenu = lazyMenu
         window.push_handlers(self)
         self.keys = key.KeyStateHandler()
         window.push_handlers(self.keys)
-        self.roomX, self.roomY = 8,8
         pyglet.resource.add_font("8bitlimo.ttf")
         self.font = font.load('8-bit Limit O BRK', 16, bold=False, italic=False)
+        self.pfont = font.load('Courier New', 10)
         self.hfont = font.load('8-bit Limit O BRK', 36, bold=False, italic=False)
-        self.ts = TileSet("tiles.png", 32, 32, 32, 32)
-        self.room = Room(self.ts, 0, 32, codemap=codemap)
-        self.fps_display = pyglet.clock.ClockDisplay()
-        self.ouch = pyglet.resource.media("ouch.wav", streaming=False)
-        self.hbar = sprite.Sprite(pyglet.resource.image("health.png"),
+        atlas.load(SHEETS, self.renderer)
+        assets.preload(VIEWS)
+        RoomViews.__init__(self, world.World(pyglet.resource.file("world.bin")),
+                           TileSet("tiles.png", 32, 32, 32, 32),
+                           blackout=blackout, cache=cache)
+        self.frames = 0 # frames drawn.
+        self.sounds = {
+            "jump": pyglet.resource.media("jump.wav", streaming=False),
+            "ouch": pyglet.resource.media("ouch.wav", streaming=False),
+        }
+        self.hbar = sprite.Sprite(atlas.image("health.png"),
                                   x=10, y=self.window.height-25)
+        self.title = self.roomnum = None # room name texts.
         self.loadTitle()
-        pyglet.clock.schedule(self.update)
-        pyglet.clock.schedule_interval(self.checkHealth, 0.125)
+        self.setScheduler()
+        assets.listener = self.note # loads after startup can cause hitches.
 
     def loadTitle(self):
-        self.player = Player(10*32, 1*32, self.room)
         self.player.setFrame(4)
         self.loadRoom(0,0)
-        self.inRoom = True
-        self.playing = False
         self.menuIndex = 0
 
+    def setScheduler(self):
+        """Choose how often to update and redraw for the current state."""
+        pyglet.clock.unschedule(self.update)
+        self.window.invalid = True
+        if self.lazyMenu and not self.playing:
+            return # sleep until there is input; see on_draw.
+        if self.window.vsync or not self.fps:
+            pyglet.clock.schedule(self.update) # every frame; flip waits for vsync.
+        else:
+            pyglet.clock.schedule_interval(self.update, 1.0/self.fps)
+
     def on_draw(self):
-        self.window.clear()
-        glLoadIdentity()
-        glTranslatef(14,0,0)
+        self.lap(None) # waiting for the frame is not our time.
+        self.frames += 1
+        if self.lazyMenu and not self.playing:
+            self.window.invalid = False # until the next key press.
+        r = self.renderer
+        r.beginFrame(self.window)
+        r.push(14,0)
         if self.inRoom:
-            glPushMatrix()
-            glTranslatef(self.room.x, self.room.y - self.room.bounce, 0)
-            self.room.draw()
-            self.player.draw()
-            glPopMatrix()
+            r.push(self.room.x, self.room.y - self.room.bounce)
+            alpha = self.lag / sim.STEP # progress towards the next tick.
+            drawRoom(r, self.room, self.player, alpha)
+            r.pop()
         # player health bar.
         if self.playing:
             x,y=10,self.window.height-10
             if self.player.health > 0:
-                fillRect(x+3,y-12,1+self.player.health*2,9,0.25,1,0.25)
-            self.hbar.draw()
+                r.rect(x+3,y-12,1+self.player.health*2,9,0.25,1,0.25)
+            r.sprite(self.hbar)
             # room name.
-            self.title.draw()
-            self.roomnum.draw()
+            r.text(self.title)
+            r.text(self.roomnum)
         else:
-            font.Text(self.hfont, "Belle of", x=90, y=320).draw()
-            font.Text(self.hfont, "Nine Fables", x=120, y=270).draw()
+            r.text(font.Text(self.hfont, "Belle of", x=90, y=320))
+            r.text(font.Text(self.hfont, "Nine Fables", x=120, y=270))
             x,y = 200,200
             for item in ("Continue","New Game","Instructions","Exit"):
-                font.Text(self.font, item, x=x, y=y).draw()
+                r.text(font.Text(self.font, item, x=x, y=y))
                 y -= 24
-            font.Text(self.font, ">", x=x-20, y=200+2-self.menuIndex*24).draw()
-        #self.fps_display.draw()
+            r.text(font.Text(self.font, ">", x=x-20, y=200+2-self.menuIndex*24))
+        r.pop()
+        self.lap("draw")
+        if self.showProfile:
+            self.drawProfile(r)
+        r.endFrame()
+        if self.playing:
+            # the first frame after a room change, and the first showing it.
+            self.roomChanges.mark("draw")
+            if self.inRoom:
+                self.roomChanges.mark("reveal")
+        self.lap("other")
+        self.profiler.endFrame()
+        if self.playing:
+            self.hitches.endFrame(self.profiler.latest, (self.roomX, self.roomY))
+        else:
+            self.hitches.reset()
+
+    def drawProfile(self, r):
+        """Draw frame time percentiles; red after a frame over budget."""
+        now = time.time()
+        if now >= self.profileDue:
+            self.profileDue = now + 0.5
+            prof = self.profiler
+            cache = self.prepared
+            lines = ["fps %.1f" % pyglet.clock.get_fps()] + prof.report() + [
+                "rooms: %d cached, %dK, %d hits, %d misses, %d evicted" % (
+                    len(cache), cache.memory() // 1024, cache.hits,
+                    cache.misses, cache.evictions)]
+            color = (1,1,1,1)
+            if prof.slow:
+                lines.append("last: " + prof.describe(prof.slow))
+                prof.slow = None
+                color = (1,0.25,0.25,1)
+            y = self.window.height - 80
+            self.profileText = []
+            for line in lines:
+                self.profileText.append(font.Text(self.pfont, line, x=10, y=y, color=color))
+                y -= 14
+        for t in self.profileText:
+            r.text(t)
+
+    def on_expose(self):
+        self.window.invalid = True
 
     def on_key_press(self, symbol, modifiers):
+        self.window.invalid = True
+        if symbol == key.F3:
+            self.showProfile = not self.showProfile
+            self.profileDue = 0
         if symbol == key.F12:
             pyglet.image.get_buffer_manager().get_color_buffer().save('screenshot.png')
         if not self.playing:
@@ -707,82 +735,137 @@ class Game(object):
                 self.startGame()
 
     def update(self, dt):
-        if self.inRoom and self.playing:
-            # apply player movement.
-            keys = self.keys
-            dx,dy = 0,0
-            if keys[key.A] or keys[key.LEFT] or keys[key.Z]:
-                dx = -dt
-            if keys[key.D] or keys[key.RIGHT] or keys[key.X]:
-                dx = dt
-            if keys[key.W] or keys[key.UP] or keys[key.APOSTROPHE]:
-                dy = dt
-            if keys[key.S] or keys[key.DOWN] or keys[key.SLASH]:
-                dy = -dt
-            jump = keys[key.SPACE] or keys[key.ENTER]
-            self.player.move(dx, dy, jump, dt)
-
-            # change room when the player reaches the edge.
-            x,y = self.player.x, self.player.y
-            if x < 0:
-                self.player.x = ROOMWIDTH-TILE_W
-                self.changeRoom(-1,0)
-            elif x > ROOMWIDTH-TILE_W:
-                self.player.x = 0
-                self.changeRoom(1,0)
-            if y < 0:
-                self.player.y = ROOMHEIGHT-TILE_H
-                self.changeRoom(0,1)
-            elif y > ROOMHEIGHT-TILE_H:
-                self.player.y = 0
-                self.changeRoom(0,-1)
-
-            # update all objects
-            for s in self.objs:
-                s.update(dt)
-
-    def checkHealth(self, dt):
-        if self.room.bounce > 0:
-            self.room.bounce -= 1
-        if self.player.health > 0:
-            self.player.checkDamage()
-            if self.player.defecit > 0:
-                self.player.defecit -= 1
-                self.player.health -= 1
-                self.ouch.play()
+        """Poll input, run logic ticks and play their sounds."""
+        self.lap(None) # time between frames is not ours.
+        keys = self.keys
+        buttons = 0
+        if keys[key.A] or keys[key.LEFT] or keys[key.Z]:
+            buttons |= sim.B_LEFT
+        if keys[key.D] or keys[key.RIGHT] or keys[key.X]:
+            buttons |= sim.B_RIGHT
+        if keys[key.W] or keys[key.UP] or keys[key.APOSTROPHE]:
+            buttons |= sim.B_UP
+        if keys[key.S] or keys[key.DOWN] or keys[key.SLASH]:
+            buttons |= sim.B_DOWN
+        if keys[key.SPACE] or keys[key.ENTER]:
+            buttons |= sim.B_JUMP
+        self.buttons = buttons
+        self.lap("input")
+        sim.Simulation.update(self, dt)
+        animator.tick(dt)
+        for name in self.room.events:
+            self.note("sound", name)
+            self.sounds[name].play()
+        if self.replay is not None and self.replay.done():
+            pyglet.app.exit()
+        self.lap("other")
 
     def startGame(self):
-        self.changeRoom(0,0)
-        self.player.x, self.player.y = 8*32, 1*32
-        self.playing = True
-
-    def changeRoom(self,x,y):
-        """Clear active room, schedule next room."""
-        self.roomX = max(self.roomX + x, 0)
-        self.roomY = max(self.roomY + y, 0)
-        self.inRoom = False
-        self.loadRoom(self.roomX, self.roomY)
-        def nextRoom(dt):
-            self.inRoom = True
-        pyglet.clock.schedule_once(nextRoom, 0.25)
+        sim.Simulation.startGame(self)
+        self.setScheduler()
+
+    def changeRoom(self, x, y):
+        crossed = self.playing # else we are starting a game.
+        if crossed:
+            self.roomChanges.edge()
+        RoomViews.changeRoom(self, x, y)
+        if crossed:
+            self.roomChanges.mark("load")
 
     def loadRoom(self, roomX, roomY):
-        roomId = roomY * rooms.width + roomX
-        tiles = rooms.rooms[roomId*2]
-        codes = rooms.rooms[roomId*2+1]
-        self.objs = [self.player]
-        self.room.load(tiles, codes, self.objs)
-        base = self.window.height - 52
+        RoomViews.loadRoom(self, roomX, roomY)
         ix,iy = roomX-8,roomY-8 # relative to start.
-        self.title = font.Text(self.font,
-            NAMES.get((ix,iy),"Belle of Nine Fables"), x=10, y=base)
-        self.roomnum = font.Text(self.font,
-            "%d:%d" % (abs(ix),abs(iy)), x=280, y=base)
+        name = NAMES.get((ix,iy),"Belle of Nine Fables")
+        number = "%d:%d" % (abs(ix),abs(iy))
+        if self.title is None:
+            base = self.window.height - 52
+            self.title = font.Text(self.font, name, x=10, y=base)
+            self.roomnum = font.Text(self.font, number, x=280, y=base)
+        else:
+            # reuse the layouts rather than leave old ones to the collector.
+            self.title.text = name
+            self.roomnum.text = number
 
 
 def main():
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option("--fps", type="int", default=TARGET_FPS,
+                      help="frame cap without vsync, 0 for none")
+    parser.add_option("--no-vsync", dest="vsync", action="store_false", default=True)
+    parser.add_option("--busy-menu", dest="lazyMenu", action="store_false",
+                      default=True, help="keep redrawing the title menu")
+    parser.add_option("--blackout", type="float", default=BLACKOUT,
+                      help="seconds to blank the screen on room changes")
+    parser.add_option("--software-gl", action="store_true", default=False,
+                      help="draw with Mesa's software rasterizer (see run_game.py)")
+    parser.add_option("--budget", type="float", metavar="MS",
+                      help="frame time budget for the profiler (default 1000/fps)")
+    parser.add_option("--profile", action="store_true", default=False,
+                      help="show frame time percentiles; F3 toggles them")
+    parser.add_option("--profile-log", metavar="FILE",
+                      help="describe frames over budget in FILE")
+    parser.add_option("--hitch", type="float", metavar="MS",
+                      help="log frames slower than MS (default two frames), 0 for none")
+    parser.add_option("--hitch-log", metavar="FILE", default=HITCH_LOG,
+                      help="rotating log of slow frames; summarize with hitches.py")
+    parser.add_option("--room-cache", type="int", metavar="KB",
+                      default=sim.ROOM_CACHE_BYTES // 1024,
+                      help="memory for prepared rooms kept for revisits")
+    parser.add_option("--latency-log", metavar="FILE",
+                      help="save room change times to FILE on exit; read with latency.py")
+    parser.add_option("--room-slo", type="float", metavar="MS",
+                      help="p99 target for revealing a new room; exit with status 1 if missed")
+    parser.add_option("--clocked", action="store_true", default=False,
+                      help="place patrolling enemies by the game clock")
+    parser.add_option("--record", metavar="FILE",
+                      help="save the input of the game played to FILE")
+    parser.add_option("--replay", metavar="FILE",
+                      help="play back input saved with --record, then exit")
+    options, args = parser.parse_args()
     resource.path.insert(0, 'data')
     resource.reindex()
-    window = pyglet.window.Window(width=540, height=480, caption="Belle of Nine Fables")
-    game = Game(window)
+    window = pyglet.window.Window(width=540, height=480, caption="Belle of Nine Fables",
+                                  vsync=options.vsync)
+    budget = options.budget and options.budget / 1000.0 or 1.0 / (options.fps or TARGET_FPS)
+    log = options.profile_log and open(options.profile_log, "w")
+    profiler = PhaseProfiler(budget, log=log)
+    if options.hitch is None:
+        threshold = 2.0 / (options.fps or TARGET_FPS)
+    else:
+        threshold = options.hitch / 1000.0
+    if threshold:
+        detector = HitchDetector(threshold, options.hitch_log)
+    else:
+        detector = HitchDetector(1e9, None) # never a hitch.
+    slo = options.room_slo and options.room_slo / 1000.0
+    game = Game(window, options.fps, options.lazyMenu, options.blackout,
+                profiler=profiler, hitches=detector, cache=options.room_cache * 1024,
+                roomChanges=RoomChanges(slo))
+    game.showProfile = options.profile
+    game.clocked = options.clocked
+    if options.record:
+        game.recording = sim.InputLog()
+    if options.replay:
+        game.replay = sim.loadInputLog(options.replay)
+        game.startGame()
+    start = time.time()
     pyglet.app.run()
+    if options.record and game.playing:
+        game.recording.save(options.record)
+    if options.replay:
+        elapsed = max(time.time() - start, 1e-6)
+        print "replayed %d ticks, %d frames in %.2fs: %.1f fps" % (
+            game.ticks, game.frames, elapsed, game.frames / elapsed)
+        print "\n".join(profiler.report())
+    if log:
+        log.write("\n".join(profiler.report()) + "\n")
+        log.close()
+    detector.close()
+    changes = game.roomChanges
+    if options.latency_log:
+        changes.save(options.latency_log)
+    if options.replay or slo:
+        print "\n".join(changes.report())
+    if not changes.met():
+        sys.exit(1)
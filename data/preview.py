@@ -5,5 +5,8 @@ sys.path.append("../scripts")
 import make_rooms
 make_rooms.convert("_preview.tga", "../rooms.py")
 
+import make_world
+make_world.convert("../rooms.py", "world.bin")
+
 import bpalace
 bpalace.main()
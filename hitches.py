@@ -0,0 +1,162 @@
+"""Hitch detection: frames that took too long, and what happened in them.
+
+The game notes events as they happen (room changes, asset loads, vertex
+uploads, sounds) and calls endFrame() after each frame it draws. Frames
+slower than the threshold are written as JSON lines to a rotating log.
+
+usage: python hitches.py [hitches.log]
+
+prints a summary of the hitches in a log and its rotated backups.
+"""
+
+import gc, os, sys, time
+import logging, logging.handlers
+
+from profiler import timer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json # Python 2.5
+
+LOGFILE = "hitches.log"
+LOGSIZE = 256*1024 # bytes per log file before rotating.
+BACKUPS = 3 # rotated log files to keep.
+
+
+def gcGeneration(old, new):
+    """Guess the oldest generation collected between two gc.get_count()s,
+    or None. Each collection resets its own count and bumps the next."""
+    if new[2] < old[2]:
+        return 2
+    if new[2] > old[2] or new[1] < old[1]:
+        return 1
+    if new[1] > old[1]:
+        return 0
+    return None
+
+
+class HitchDetector(object):
+    """Records frames slower than a threshold with the events in them."""
+
+    def __init__(self, threshold=2/60.0, filename=LOGFILE):
+        self.threshold = threshold # seconds between frames.
+        self.frames = 0
+        self.hitches = 0
+        self.events = [] # (kind, detail) noted this frame.
+        self.last = None # time the previous frame ended.
+        self.gccount = gc.get_count()
+        self.log = None
+        self.handler = None # ours on the shared logger, until close().
+        if filename:
+            self.log = logging.getLogger("bpalace.hitches")
+            self.log.propagate = False
+            self.handler = logging.handlers.RotatingFileHandler(filename,
+                maxBytes=LOGSIZE, backupCount=BACKUPS)
+            self.handler.setFormatter(logging.Formatter("%(message)s"))
+            self.log.addHandler(self.handler)
+            self.log.setLevel(logging.INFO)
+
+    def close(self):
+        """Stop logging, so another detector does not log through us too."""
+        if self.handler:
+            self.log.removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
+        self.log = None
+
+    def note(self, kind, detail=""):
+        """Note something that may slow down the current frame."""
+        self.events.append((kind, str(detail)))
+
+    def reset(self):
+        """Forget the current frame, e.g. while the game sleeps."""
+        self.last = None
+        self.events = []
+        self.gccount = gc.get_count()
+
+    def endFrame(self, phases=None, room=None):
+        """Check the time since the last frame; returns True for a hitch.
+        phases maps frame phases to seconds, as from PhaseProfiler."""
+        now = timer()
+        count = gc.get_count()
+        gen = gcGeneration(self.gccount, count)
+        if gen is not None:
+            self.note("gc", "gen%d" % gen)
+        self.gccount = count
+        hitch = self.last is not None and now - self.last > self.threshold
+        if hitch:
+            self.hitches += 1
+            if self.log:
+                record = {"time": round(time.time(), 3), "frame": self.frames,
+                          "ms": round((now - self.last) * 1000, 2),
+                          "events": self.events}
+                if phases:
+                    record["phases"] = dict([(phase, round(t*1000, 2))
+                                                for phase,t in phases.items() if t])
+                if room:
+                    record["room"] = list(room)
+                self.log.info(json.dumps(record, sort_keys=True))
+        self.frames += 1
+        self.last = now
+        self.events = []
+        return hitch
+
+
+def loadLog(filename):
+    """Read hitch records from a log and its rotated backups, oldest first."""
+    records = []
+    names = ["%s.%d" % (filename, n) for n in xrange(BACKUPS, 0, -1)] + [filename]
+    for name in names:
+        if os.path.exists(name):
+            for line in open(name):
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+def causes(record):
+    """Name what probably caused a hitch: its events, else its slowest phase."""
+    kinds = []
+    for kind,detail in record.get("events", ()):
+        if kind not in kinds:
+            kinds.append(kind)
+    if not kinds and record.get("phases"):
+        slowest = max([(t, phase) for phase,t in record["phases"].items()])
+        kinds.append("phase:" + slowest[1])
+    return kinds or ["unknown"]
+
+def summarize(records, out=sys.stdout):
+    if not records:
+        print >>out, "no hitches"
+        return
+    times = sorted([r["ms"] for r in records])
+    n = len(times)
+    print >>out, "%d hitches: median %.1fms, p95 %.1fms, worst %.1fms" % (
+        n, times[n//2], times[min(n-1, int(n*0.95))], times[-1])
+    counts = {}
+    for r in records:
+        for kind in causes(r):
+            counts[kind] = counts.get(kind, 0) + 1
+    print >>out, "\ncauses (a hitch may have several):"
+    for count,kind in sorted([(c,k) for k,c in counts.items()], reverse=True):
+        print >>out, "  %-16s %5d  %5.1f%%" % (kind, count, count*100.0/n)
+    rooms = {}
+    for r in records:
+        if "room" in r:
+            key = "%d,%d" % tuple(r["room"])
+            rooms[key] = rooms.get(key, 0) + 1
+    if rooms:
+        print >>out, "\nrooms with most hitches:"
+        for count,key in sorted([(c,k) for k,c in rooms.items()], reverse=True)[:5]:
+            print >>out, "  %-8s %5d" % (key, count)
+    print >>out, "\nworst frames:"
+    for r in sorted(records, key=lambda r: r["ms"], reverse=True)[:5]:
+        events = ", ".join(["%s %s" % (kind, detail) for kind,detail in r.get("events", ())])
+        print >>out, "  %7.1fms  %s" % (r["ms"], events or ", ".join(causes(r)))
+
+def main():
+    filename = len(sys.argv) > 1 and sys.argv[1] or LOGFILE
+    summarize(loadLog(filename))
+
+if __name__ == "__main__":
+    main()
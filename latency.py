@@ -0,0 +1,150 @@
+"""Room change latency: from crossing the edge of a room to seeing the next.
+
+The game calls edge() when the player crosses an edge and mark(step) as
+each later step of the change happens: the new room loaded, its first
+frame drawn and, after any blackout, revealed. The time from the edge
+to each step goes into an HDR-style histogram, which keeps every value
+to a fixed relative precision in a few hundred buckets at most.
+
+usage: python latency.py [latency.json] [p99 target ms]
+
+prints the percentiles of room changes saved by the game's --latency-log,
+and exits with status 1 if the reveal p99 misses the target.
+"""
+
+import math, sys
+
+from profiler import timer
+from hitches import json
+
+LOGFILE = "latency.json"
+
+# steps of a room change after the edge crossing, in order.
+STEPS = ("load", "draw", "reveal")
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram(object):
+    """Log-linear histogram of times. Values below 2**(bits+1) units
+    get a bucket each; above that, each power of two is split into
+    2**bits buckets, so a value is off by at most 1/2**bits of itself."""
+
+    def __init__(self, bits=5, unit=1e-6):
+        self.bits = bits
+        self.unit = unit # seconds per counted unit.
+        self.buckets = {} # (shift, value >> shift) -> count.
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        n = max(0, int(seconds / self.unit + 0.5))
+        shift = max(0, math.frexp(n)[1] - 1 - self.bits)
+        key = (shift, n >> shift)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Get the p'th percentile in seconds: the top of its bucket."""
+        if not self.count:
+            return 0
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for (shift,value),count in sorted(self.buckets.items()):
+            seen += count
+            if seen >= rank:
+                top = (((value + 1) << shift) - 1) * self.unit
+                return min(top, self.max)
+        return self.max
+
+    def mean(self):
+        return self.count and self.total / self.count
+
+    def dump(self):
+        """Get the histogram as plain data for JSON."""
+        return {"bits": self.bits, "unit": self.unit, "count": self.count,
+                "total": self.total, "max": self.max,
+                "buckets": [[shift, value, count] for (shift,value),count
+                                in sorted(self.buckets.items())]}
+
+    def load(self, data):
+        self.bits, self.unit = data["bits"], data["unit"]
+        self.count, self.total, self.max = data["count"], data["total"], data["max"]
+        self.buckets = dict([((shift, value), count)
+                                for shift,value,count in data["buckets"]])
+
+
+class RoomChanges(object):
+    """Times the steps of each room change from its edge crossing."""
+
+    def __init__(self, slo=None):
+        self.slo = slo # seconds allowed for the reveal p99, if any.
+        self.histograms = dict([(step, Histogram()) for step in STEPS])
+        self.start = None # time of the edge crossing being followed.
+        self.done = [] # steps marked since then.
+
+    def edge(self):
+        """Start timing a room change; drops one still in progress."""
+        self.start = timer()
+        self.done = []
+
+    def mark(self, step):
+        """Record the time since the edge the first time a step happens."""
+        if self.start is None or step in self.done:
+            return
+        self.histograms[step].record(timer() - self.start)
+        self.done.append(step)
+        if step == STEPS[-1]:
+            self.start = None
+
+    def met(self):
+        """Whether the reveal p99 is within the target, if there is one."""
+        if self.slo is None:
+            return True
+        return self.histograms["reveal"].percentile(99) <= self.slo
+
+    def report(self):
+        """Lines of percentiles for the time to each step."""
+        count = self.histograms[STEPS[-1]].count
+        lines = ["%d room changes; ms from the edge to:" % count,
+                 "%-8s" % "" + "".join(["%8s" % ("p%g" % p) for p in PERCENTILES])
+                     + "%8s" % "max"]
+        for step in STEPS:
+            h = self.histograms[step]
+            lines.append("%-8s" % step + "".join(["%8.2f" % (h.percentile(p)*1000)
+                                                      for p in PERCENTILES])
+                            + "%8.2f" % (h.max*1000))
+        if self.slo is not None:
+            lines.append("reveal p99 target %.2fms: %s" % (self.slo*1000,
+                            self.met() and "met" or "MISSED"))
+        return lines
+
+    def save(self, filename):
+        f = open(filename, "w")
+        try:
+            json.dump(dict([(step, h.dump()) for step,h in self.histograms.items()]),
+                      f, sort_keys=True)
+        finally:
+            f.close()
+
+def loadRoomChanges(filename, slo=None):
+    """Read histograms written by RoomChanges.save."""
+    changes = RoomChanges(slo)
+    data = json.load(open(filename))
+    for step in STEPS:
+        changes.histograms[step].load(data[step])
+    return changes
+
+def main():
+    filename = len(sys.argv) > 1 and sys.argv[1] or LOGFILE
+    slo = len(sys.argv) > 2 and float(sys.argv[2]) / 1000.0 or None
+    changes = loadRoomChanges(filename, slo)
+    print "\n".join(changes.report())
+    if not changes.met():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
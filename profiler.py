@@ -0,0 +1,84 @@
+"""Per-frame phase timing with rolling percentiles.
+
+The game calls lap(phase) as each part of a frame finishes, so the time
+since the previous lap is charged to that phase, and endFrame() once the
+frame is drawn.
+"""
+
+import sys, time
+
+if sys.platform == "win32":
+    timer = time.clock
+else:
+    timer = time.time
+
+# phases of a frame, in display order.
+PHASES = ("input", "move", "objects", "health", "room", "draw", "other")
+
+
+def percentile(values, p):
+    """Get the p'th percentile of a sorted list."""
+    if not values:
+        return 0
+    return values[min(len(values)-1, int(len(values) * p / 100.0))]
+
+
+class PhaseProfiler(object):
+    """Time spent in each phase of recent frames."""
+
+    def __init__(self, budget=1/60.0, size=240, log=None):
+        self.budget = budget # seconds of work allowed per frame.
+        self.size = size # frames kept for percentiles.
+        self.log = log # file to describe slow frames in, if any.
+        self.frames = 0
+        self.over = 0 # frames over budget.
+        self.slow = None # phase times of the last frame over budget.
+        self.history = [] # phase times of recent frames.
+        self.latest = None # phase times of the last frame.
+        self.current = dict.fromkeys(PHASES, 0.0)
+        self.last = timer()
+
+    def lap(self, phase):
+        """Charge the time since the last lap to phase; None drops it."""
+        now = timer()
+        if phase:
+            self.current[phase] += now - self.last
+        self.last = now
+
+    def endFrame(self):
+        """Finish timing a frame; returns its total time."""
+        times = self.current
+        times["frame"] = total = sum(times.values())
+        self.latest = times
+        if len(self.history) < self.size:
+            self.history.append(times)
+        else:
+            self.history[self.frames % self.size] = times
+        self.frames += 1
+        if total > self.budget:
+            self.over += 1
+            self.slow = times
+            if self.log:
+                self.log.write("frame %d: %.2fms; %s\n" % (
+                    self.frames, total*1000, self.describe(times)))
+        self.current = dict.fromkeys(PHASES, 0.0)
+        return total
+
+    def describe(self, times):
+        """Name the phases of a frame, slowest first."""
+        phases = [(times[phase], phase) for phase in PHASES if times[phase]]
+        phases.sort(reverse=True)
+        return ", ".join(["%s %.2fms" % (phase, t*1000) for t,phase in phases])
+
+    def percentiles(self, name, ps=(50,95,99)):
+        values = sorted([times[name] for times in self.history])
+        return [percentile(values, p) for p in ps]
+
+    def report(self):
+        """Lines of p50/p95/p99 times for the frame and each phase."""
+        lines = ["%-8s %6s %6s %6s" % ("ms", "p50", "p95", "p99")]
+        for name in ("frame",) + PHASES:
+            p50,p95,p99 = self.percentiles(name)
+            lines.append("%-8s %6.2f %6.2f %6.2f" % (name, p50*1000, p95*1000, p99*1000))
+        lines.append("over budget: %d of %d frames" % (self.over, self.frames))
+        return lines
@@ -5,6 +5,10 @@ try:
 except:
     pass
 
+# Mesa reads this when the GL library loads, before bpalace imports it.
+if "--software-gl" in sys.argv:
+    os.environ["LIBGL_ALWAYS_SOFTWARE"] = "1"
+
 import bpalace
 if __name__ == "__main__":
     bpalace.main()
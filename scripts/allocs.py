@@ -0,0 +1,113 @@
+"""Check that steady-state game ticks allocate next to nothing.
+
+usage: python allocs.py [options]
+
+Replays input (bench.py's default script, or --log) through the game
+logic and counts the objects each tick leaves for the garbage collector
+to track, from the change in gc.get_count() with collection turned off.
+Python 2 has no tracemalloc, but this is the count that sets off a
+collection, and collections are what show up as frame hitches.
+
+Ticks that change or prepare rooms are reported apart from the rest;
+the exit status is 1 if any other tick went over --budget. Now and then
+a tick refills one of Python's free lists and counts a few objects, so
+the default budget is a little above zero.
+"""
+import gc, os, sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import sim
+import bench
+
+BUDGET = 8 # objects a steady tick may leave.
+
+
+class CountingSimulation(sim.Simulation):
+    """Simulation that remembers whether a frame touched rooms."""
+
+    roomFrame = False
+
+    def note(self, kind, detail=""):
+        if kind in ("room", "prepare"):
+            self.roomFrame = True
+
+
+def liveTypes():
+    """Count the objects the garbage collector tracks, by type name."""
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def measure(w, log, passes):
+    """Replay a log once to fill caches, then several times more with
+    collection off; returns the objects left by each steady tick and by
+    each room tick, and the tracked types that grew over those passes."""
+    s = CountingSimulation(w)
+    s.replay = log
+    s.startGame()
+    while not log.done():
+        s.update(sim.STEP)
+    steady, rooms = [], []
+    liveTypes() # the first census allocates some type attributes.
+    gc.collect()
+    before = liveTypes()
+    gc.disable()
+    try:
+        for n in xrange(0,passes):
+            s.startGame()
+            while not log.done():
+                s.roomFrame = False
+                count = gc.get_count()[0]
+                s.update(sim.STEP)
+                left = gc.get_count()[0] - count
+                if s.roomFrame:
+                    rooms.append(left)
+                else:
+                    steady.append(left)
+    finally:
+        gc.enable()
+    gc.collect()
+    after = liveTypes()
+    grown = dict([(name, count - before.get(name, 0)) for name,count in after.items()
+                        if count > before.get(name, 0)])
+    return steady, rooms, grown
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--budget", type="int", default=BUDGET,
+                      help="objects a steady tick may leave (default %d)" % BUDGET)
+    parser.add_option("--passes", type="int", default=3,
+                      help="measured replays of the input (default 3)")
+    parser.add_option("--log", metavar="FILE",
+                      help="input log from the game's --record to replay")
+    parser.add_option("--world", metavar="FILE", help="world file to load")
+    options, args = parser.parse_args()
+    if options.world:
+        w = sim.world.World(open(options.world, "rb"))
+    else:
+        w = sim.loadWorld()
+    if options.log:
+        log = sim.loadInputLog(options.log)
+    else:
+        log = sim.InputLog()
+        log.runs = [list(run) for run in sim.parseScript(bench.DEFAULT_INPUT)]
+
+    steady, rooms, grown = measure(w, log, options.passes)
+    for name,ticks in (("steady", steady), ("room", rooms)):
+        if ticks:
+            over = len([n for n in ticks if n > options.budget])
+            print "%-7s %6d ticks: %7.2f objects/tick, worst %d, %d over budget" % (
+                name, len(ticks), float(sum(ticks)) / len(ticks), max(ticks), over)
+    if grown:
+        print "tracked objects gained over %d passes:" % options.passes
+        for count,name in sorted([(c,n) for n,c in grown.items()], reverse=True)[:10]:
+            print "  %-16s %6d" % (name, count)
+    if [n for n in steady if n > options.budget]:
+        print "steady ticks over a budget of %d objects" % options.budget
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
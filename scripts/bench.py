@@ -0,0 +1,312 @@
+"""Time the game's hot paths without a window.
+
+usage: python bench.py [options] [benchmark ...]
+
+Each benchmark is run several times and reports seconds per operation.
+room_draw draws through bpalace's CountingRenderer by default, which
+needs pyglet but no display, and also reports the GL work per frame;
+--renderer gl or software time real drawing in a hidden window, so
+they need a display and are skipped without one.
+--save writes the results as JSON; --baseline compares the medians with
+an earlier --save and exits with status 1 if any benchmark got slower
+than the tolerance allows, or if any benchmark failed; the others are
+still run and saved. Baselines only mean something on the machine that
+saved them.
+"""
+import os, sys, traceback, warnings
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import sim
+from profiler import timer
+from hitches import json
+
+FORMAT = 1 # version of the saved results.
+
+# input replayed by player_move when no log is given.
+DEFAULT_INPUT = ("right:300,right+jump:40,left:200,up:120,left+jump:60,"
+                 "down:120,right:400,jump:30,left:500,none:60")
+
+
+def allRooms(w):
+    return [(x,y) for y in xrange(0,w.height) for x in xrange(0,w.width)]
+
+def prepareAll(w, room):
+    """Prepare every room of a world."""
+    return [room.prepare(w.layer(x,y,0), w.layer(x,y,1), w.layerwidth, w.layerheight)
+                for x,y in allRooms(w)]
+
+
+def benchRoomLoad(w, options):
+    """Prepare and enter every room, spawning its actors from the pools
+    the previous room left, as the game does."""
+    rooms = allRooms(w)
+    room = sim.Room(0, 32, codemap=sim.codemap)
+    lw,lh = w.layerwidth, w.layerheight
+    def run():
+        objs = []
+        for x,y in rooms:
+            data = room.prepare(w.layer(x,y,0), w.layer(x,y,1), lw, lh)
+            room.release(objs)
+            objs = []
+            room.load(data, objs)
+        return len(rooms)
+    return run
+
+def benchHitTests(w, options):
+    """Tile hit tests in the mix Player.move and checkDamage make."""
+    room = sim.Room(0, 32, codemap=sim.codemap)
+    rooms = []
+    for n,data in enumerate(prepareAll(w, room)):
+        queries = []
+        for i in xrange(0,64):
+            # spread player-sized rectangles over the room.
+            x = (i*37 + n*11) % (sim.ROOMWIDTH - 32)
+            y = (i*53 + n*7) % (sim.ROOMHEIGHT - 48)
+            queries.append((x, y))
+        rooms.append((data.colmap, queries))
+    def run():
+        ops = 0
+        for colmap,queries in rooms:
+            room.colmap = colmap
+            for x,y in queries:
+                room.tileTest(x+2, y-1, 27, 48, sim.T_CLIMBABLE) # ladders.
+                room.hitTest(x+29, y, x+31, y+47, sim.T_SOLID) # walking right.
+                room.hitTest(x+2, y-4, x+29, y, sim.T_SOLID) # falling.
+                room.hitTest(x+2, y+47, x+29, y+51, sim.T_SOLID) # jumping.
+                room.tileTest(x+6, y, 20, 28, sim.T_DAMAGE) # health check.
+                ops += 5
+        return ops
+    return run
+
+def benchPlayerMove(w, options):
+    """Replay recorded input through Player.move in rooms without actors."""
+    if options.log:
+        log = sim.loadInputLog(options.log)
+    else:
+        log = sim.InputLog()
+        log.runs = [list(run) for run in sim.parseScript(DEFAULT_INPUT)]
+    def run():
+        s = sim.Simulation(w, codemap={})
+        s.replay = log
+        s.startGame()
+        while not log.done():
+            s.tick(sim.STEP)
+        return len(log)
+    return run
+
+def benchEnemies(w, options):
+    """Update every patrolling enemy and drop rope in the world."""
+    rooms = []
+    for data in prepareAll(w, sim.Room(0, 32, codemap=sim.codemap)):
+        # each room steps its own patrols.
+        room = sim.Room(0, 32, codemap=sim.codemap)
+        room.load(data, [])
+        if len(room.patrols):
+            rooms.append(room)
+    count = sum([len(room.patrols) for room in rooms])
+    ticks = 120
+    def run():
+        step = sim.STEP
+        for i in xrange(0,ticks):
+            for room in rooms:
+                room.patrols.step(step)
+        return ticks * count
+    return run
+
+def benchCrowd(w, options):
+    """Update a room crowded with a thousand patrolling crawlers."""
+    room = sim.Room(0, 32, codemap=sim.codemap)
+    for i in xrange(0,1000):
+        x,y = (i*37) % (sim.ROOMWIDTH-64) + 32, (i*29) % (sim.ROOMHEIGHT-32)
+        crawler = sim.Crawler(x, y, room, (32, sim.ROOMWIDTH-64))
+        room.index.insert(crawler)
+    room.patrols.pack()
+    ticks = 120
+    def run():
+        step = sim.STEP
+        for i in xrange(0,ticks):
+            room.patrols.step(step)
+        return ticks * len(room.patrols)
+    return run
+
+def makeRenderer(kind):
+    """Import the game with a renderer of some kind."""
+    if kind == "software":
+        os.environ["LIBGL_ALWAYS_SOFTWARE"] = "1" # before GL loads.
+    import pyglet
+    if kind == "null":
+        # pyglet 1.1 opens a hidden shadow window when its GL module loads,
+        # which needs a display; the counting renderer has no use for it.
+        pyglet.options["shadow_window"] = False
+    import bpalace
+    # pyglet resolves relative resource paths from the script, not here.
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+    pyglet.resource.path.insert(0, data)
+    pyglet.resource.reindex()
+    if kind == "null":
+        # vertex lists fall back to plain arrays without a context.
+        warnings.filterwarnings("ignore", "No GL context")
+        return bpalace.CountingRenderer()
+    renderer = bpalace.GLRenderer()
+    renderer.window = pyglet.window.Window(visible=False) # for its context.
+    return renderer
+
+def unavailable(e):
+    """Whether making a renderer failed because it cannot run here: no
+    pyglet, or no display for a window. The display error is matched by
+    name, as a failed pyglet.window import leaves no module to take it from."""
+    return isinstance(e, ImportError) or \
+           type(e).__name__ == "NoSuchDisplayException"
+
+def benchRoomDraw(w, options):
+    """Draw every room with its actors and the player."""
+    r = makeRenderer(options.renderer)
+    import bpalace
+    from pyglet import gl, graphics
+    bpalace.atlas.load(bpalace.SHEETS, r)
+    ts = bpalace.TileSet("tiles.png", 32, 32, 32, 32)
+    group = graphics.TextureGroup(ts.texture)
+    rooms = []
+    for data in prepareAll(w, sim.Room(0, 32, codemap=sim.codemap)):
+        data.view = bpalace.TileLayer(ts, group, data)
+        room = sim.Room(0, 32, codemap=sim.codemap)
+        objs = []
+        room.load(data, objs)
+        for obj in objs:
+            obj.view = bpalace.makeView(obj)
+        rooms.append(room)
+    player = sim.Player(8*32, 1*32, rooms[0])
+    player.view = bpalace.makeView(player)
+    frames = 4
+    def run():
+        for i in xrange(0,frames):
+            for room in rooms:
+                r.beginFrame(getattr(r, "window", None))
+                r.push(room.x, room.y)
+                bpalace.drawRoom(r, room, player, 0.5)
+                r.pop()
+                r.endFrame()
+        if options.renderer != "null":
+            gl.glFinish() # count the time the GPU took.
+        return frames * len(rooms)
+    def stats():
+        """Average GL work per drawn room."""
+        if r.frames:
+            return dict((name, float(value) / r.frames)
+                            for name,value in r.totals.items())
+    run.stats = stats
+    return run
+
+# name -> benchmark setup, in the order they run.
+BENCHMARKS = (
+    ("room_load", benchRoomLoad),
+    ("hit_tests", benchHitTests),
+    ("player_move", benchPlayerMove),
+    ("enemy_updates", benchEnemies),
+    ("crowd_updates", benchCrowd),
+    ("room_draw", benchRoomDraw),
+)
+
+
+def measure(setup, w, options):
+    """Time several runs of a benchmark; returns ops and seconds per op."""
+    run = setup(w, options)
+    run() # warm up caches.
+    times = []
+    for i in xrange(0,options.runs):
+        start = timer()
+        ops = run()
+        times.append((timer() - start) / ops)
+    times.sort()
+    result = {"ops": ops, "best": times[0], "median": times[len(times)//2]}
+    stats = getattr(run, "stats", None)
+    if stats and stats():
+        result["stats"] = stats()
+    return result
+
+def compare(results, baseline, tolerance):
+    """Print results against a baseline; returns names that regressed."""
+    slower = []
+    old = baseline.get("results", {})
+    for name,setup in BENCHMARKS:
+        if name not in results:
+            continue
+        r = results[name]
+        line = "%-14s %8d ops %10.2f us/op" % (name, r["ops"], r["median"]*1e6)
+        if name in old:
+            ratio = r["median"] / old[name]["median"]
+            line += "  %+6.1f%%" % ((ratio-1)*100)
+            if ratio > 1 + tolerance:
+                line += "  SLOWER"
+                slower.append(name)
+        print line
+        # work counts are exact, so any increase is a regression.
+        counts = r.get("stats", {})
+        oldcounts = old.get(name, {}).get("stats", {})
+        for key in sorted(counts):
+            line = "    %-10s %12.1f" % (key, counts[key])
+            if key in oldcounts and counts[key] > oldcounts[key]:
+                line += "  was %.1f  MORE" % oldcounts[key]
+                slower.append("%s.%s" % (name, key))
+            print line
+    return slower
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--runs", type="int", default=7, help="timed runs of each benchmark")
+    parser.add_option("--save", metavar="FILE", help="write results as JSON")
+    parser.add_option("--baseline", metavar="FILE", help="compare with saved results")
+    parser.add_option("--tolerance", type="float", default=0.10,
+                      help="allowed slowdown against the baseline (default 0.10)")
+    parser.add_option("--log", metavar="FILE",
+                      help="input log from the game's --record for player_move")
+    parser.add_option("--world", metavar="FILE", help="world file to load")
+    parser.add_option("--renderer", choices=("null", "gl", "software"), default="null",
+                      help="renderer for room_draw: null (default), gl or software")
+    options, args = parser.parse_args()
+    names = [name for name,setup in BENCHMARKS]
+    for name in args:
+        if name not in names:
+            parser.error("unknown benchmark %r; choose from %s" % (name, ", ".join(names)))
+    if options.world:
+        w = sim.world.World(open(options.world, "rb"))
+    else:
+        w = sim.loadWorld()
+
+    results = {}
+    failed = []
+    for name,setup in BENCHMARKS:
+        if not args or name in args:
+            try:
+                results[name] = measure(setup, w, options)
+            except Exception, e:
+                if unavailable(e):
+                    print "%-14s skipped: %s" % (name, e) # room_draw needs pyglet.
+                else:
+                    # report it, but still run and save the others.
+                    traceback.print_exc()
+                    print "%-14s failed: %s" % (name, e)
+                    failed.append(name)
+
+    baseline = {}
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+    slower = compare(results, baseline, options.tolerance)
+    if options.save:
+        f = open(options.save, "w")
+        try:
+            json.dump({"format": FORMAT, "python": sys.version.split()[0],
+                       "platform": sys.platform, "runs": options.runs,
+                       "results": results}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if failed:
+        print "failed: %s" % ", ".join(failed)
+    if slower:
+        print "slower than baseline: %s" % ", ".join(slower)
+    if failed or slower:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
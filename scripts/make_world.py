@@ -0,0 +1,20 @@
+"""Convert a rooms.py map module into a packed world file.
+
+usage: python make_world.py [rooms.py] [world.bin]
+"""
+import os, sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import world
+
+def convert(source, dest):
+    """Load room layers from a rooms.py file and save them packed."""
+    env = {}
+    execfile(source, env)
+    world.save(dest, env["width"], env["height"], env["rooms"])
+
+if __name__ == "__main__":
+    home = os.path.join(os.path.dirname(__file__), "..")
+    source = len(sys.argv) > 1 and sys.argv[1] or os.path.join(home, "rooms.py")
+    dest = len(sys.argv) > 2 and sys.argv[2] or os.path.join(home, "data", "world.bin")
+    convert(source, dest)
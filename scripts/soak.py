@@ -0,0 +1,205 @@
+"""Walk through every room of the world again and again, watching for creep.
+
+usage: python soak.py [options]
+
+Each pass snakes through every room, row by row, with changeRoom, and
+prepares the neighbours after each move as the game does between frames.
+The player leaves each room that has a springboard standing on it. Each
+room is also drawn once. After every pass it prints the process's
+resident memory, the objects Python tracks, the live actors, sprites and
+vertex lists, the uncollectable objects in gc.garbage, and room load
+times. Drawing goes through bpalace's CountingRenderer, which needs
+pyglet but no display. Without pyglet, or if pyglet still wants a
+display it cannot open, only the game logic is soaked.
+
+The first --warmup passes fill caches and pools. The exit status is 1
+if anything grew from the end of the warmup to the last pass: actors,
+sprites, vertex lists and gc.garbage must not grow at all, while memory
+and the object count are allowed --slack.
+"""
+import gc, os, sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import sim
+import bench
+from profiler import percentile, timer
+
+# counts that must not grow at all once warmed up.
+EXACT = ("actors", "sprites", "vertex lists", "uncollectable")
+
+
+def rss():
+    """Resident memory in KB; the peak where /proc is missing."""
+    try:
+        f = open("/proc/self/statm")
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (IOError, OSError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0 # Windows.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024 # bytes there.
+    return peak
+
+def census(kinds):
+    """Count the objects Python tracks, and the instances of each kind."""
+    gc.collect()
+    objs = gc.get_objects()
+    counts = dict.fromkeys([name for name,cls in kinds], 0)
+    counts["objects"] = len(objs)
+    for obj in objs:
+        for name,cls in kinds:
+            if isinstance(obj, cls):
+                counts[name] += 1
+    del objs
+    counts["uncollectable"] = len(gc.garbage) # cycles with a __del__.
+    counts["rss"] = rss()
+    return counts
+
+def snake(w):
+    """Every room of a world, each next to the one before."""
+    rooms = []
+    for y in xrange(0,w.height):
+        xs = range(0,w.width)
+        if y % 2:
+            xs.reverse()
+        rooms.extend([(x,y) for x in xs])
+    return rooms
+
+def makeGame(w, views, cache):
+    """A simulation to soak, with views drawn by a CountingRenderer if
+    we can; returns it, a frame drawing function and the kinds to count."""
+    kinds = [("actors", (sim.Actor, sim.DropRope))]
+    if views:
+        try:
+            r = bench.makeRenderer("null")
+        except Exception, e:
+            if not bench.unavailable(e):
+                raise
+            print "views skipped: %s" % e
+            views = False
+    if not views:
+        return sim.Simulation(w, cache=cache), None, kinds
+    import bpalace
+    from pyglet import sprite, graphics
+    bpalace.atlas.load(bpalace.SHEETS, r)
+    bpalace.assets.preload(bpalace.VIEWS)
+    game = bpalace.RoomViews(w, bpalace.TileSet("tiles.png", 32, 32, 32, 32),
+                             cache=cache)
+    def draw():
+        r.beginFrame()
+        r.push(game.room.x, game.room.y)
+        bpalace.drawRoom(r, game.room, game.player)
+        r.pop()
+        r.endFrame()
+    kinds += [("sprites", sprite.Sprite),
+              ("vertex lists", graphics.vertexdomain.VertexList)]
+    return game, draw, kinds
+
+def soak(w, options):
+    """Run the passes; returns the census after the warmup and after the
+    last pass. Keeping no more than that keeps our own objects flat."""
+    game, draw, kinds = makeGame(w, options.views, options.room_cache * 1024)
+    rooms = snake(w)
+    game.roomX, game.roomY = rooms[0]
+    game.loadRoom(*rooms[0])
+    base = None
+    for n in xrange(1,options.passes+1):
+        loads, prepares = [], []
+        for x,y in rooms[1:] + rooms[:1]:
+            # leave standing on a springboard where there is one, so the
+            # room keeps it back until we step off in a later room.
+            game.player.support = None
+            for obj in game.objs:
+                if getattr(obj, "supports", False):
+                    game.player.support = obj
+                    break
+            start = timer()
+            dx,dy = x - game.roomX, y - game.roomY
+            if abs(dx) + abs(dy) == 1:
+                game.changeRoom(dx, dy)
+            else:
+                # back to the start.
+                game.roomX, game.roomY = x,y
+                game.changeRoom(0, 0)
+            loads.append(timer() - start)
+            while game.prefetching:
+                start = timer()
+                game.roomData(*game.prefetching.pop())
+                prepares.append(timer() - start)
+            if draw:
+                draw()
+        counts = census(kinds)
+        loads.sort()
+        prepares.sort()
+        counts["load"] = [percentile(loads, p) for p in (50, 99, 100)]
+        counts["prepare"] = [percentile(prepares, p) for p in (50, 99, 100)]
+        if n == options.warmup:
+            base = counts
+        cache = game.prepared
+        line = "pass %3d: %7dK rss, %7d objects, %d rooms cached" % (
+            n, counts["rss"], counts["objects"], len(cache))
+        for name,cls in kinds:
+            line += ", %d %s" % (counts[name], name)
+        line += ", %d uncollectable" % counts["uncollectable"]
+        print line
+        print "          load p50 %.2fms p99 %.2fms max %.2fms;" % tuple(
+            [t*1000 for t in counts["load"]]),
+        print "prepare p50 %.2fms p99 %.2fms max %.2fms" % tuple(
+            [t*1000 for t in counts["prepare"]])
+        sys.stdout.flush()
+    return base, counts
+
+def growth(base, last, slack):
+    """Describe everything that grew from one census to another."""
+    grew = []
+    for name in sorted(base):
+        if name in ("load", "prepare"):
+            continue
+        allowed = base[name]
+        if name not in EXACT:
+            allowed = base[name] * (1 + slack)
+        if last[name] > allowed:
+            grew.append("%s %d -> %d" % (name, base[name], last[name]))
+    return grew
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--passes", type="int", default=40,
+                      help="walks through the whole world (default 40)")
+    parser.add_option("--warmup", type="int", default=3,
+                      help="passes to fill caches and pools first (default 3)")
+    parser.add_option("--slack", type="float", default=0.02,
+                      help="allowed growth in memory and objects (default 0.02)")
+    parser.add_option("--room-cache", type="int", metavar="KB",
+                      default=sim.ROOM_CACHE_BYTES // 1024,
+                      help="memory for prepared rooms, as in the game; smaller "
+                           "values make the soak evict and prepare rooms again")
+    parser.add_option("--no-views", dest="views", action="store_false", default=True,
+                      help="soak only the game logic, without pyglet")
+    parser.add_option("--world", metavar="FILE", help="world file to load")
+    options, args = parser.parse_args()
+    if not 0 < options.warmup < options.passes:
+        parser.error("--warmup must leave at least one pass to measure")
+    if options.world:
+        w = sim.world.World(open(options.world, "rb"))
+    else:
+        w = sim.loadWorld()
+
+    base, last = soak(w, options)
+    grew = growth(base, last, options.slack)
+    if grew:
+        print "grew after %d warmup passes: %s" % (options.warmup, ", ".join(grew))
+        sys.exit(1)
+    print "no growth after %d warmup passes" % options.warmup
+
+if __name__ == "__main__":
+    main()
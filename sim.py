@@ -0,0 +1,1299 @@
+"""Headless game core: rooms, collisions, player physics and enemies.
+
+Nothing here needs a window or a GL context. bpalace.Game draws this
+state; the Simulation class can also be stepped on its own, as fast as
+the CPU allows, for level checks and benchmarks (see main below).
+"""
+
+import os
+import world
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # patrols step in a plain loop instead.
+
+TILE_W, TILE_H = 32, 32
+ROOM_TW, ROOM_TH = 16, 12
+ROOMWIDTH = ROOM_TW * TILE_W
+ROOMHEIGHT = ROOM_TH * TILE_H
+
+# map codes from level editor.
+C_TORCH = 1
+C_ROPE = 2
+C_ENDROPE = 4
+C_SPRING = 5
+C_CRAWLER = 8
+C_BAT = 9
+C_SPIDER = 12
+C_SPIDERTOP = 10
+C_BLOCKER = 16
+
+# tile classes.
+SOLID = (2,3,4,5,12,13,18,19,34,35)
+CLIMBABLE = (8,10)
+SUPPORTS = SOLID + CLIMBABLE
+DAMAGE = (1,9,26)
+
+# tile class flags used by the collision grid.
+T_SOLID = 1
+T_CLIMBABLE = 2
+T_SUPPORTS = 4
+T_DAMAGE = 8
+TILE_CLASSES = ((T_SOLID, SOLID), (T_CLIMBABLE, CLIMBABLE),
+                (T_SUPPORTS, SUPPORTS), (T_DAMAGE, DAMAGE))
+TILE_FLAGS = list(sum(flag for flag,tiles in TILE_CLASSES if num in tiles)
+                    for num in xrange(256))
+
+# index of the single bit set in a power of two.
+BIT_INDEX = dict((1<<i, i) for i in xrange(64))
+
+# hit test result for no tile; shared so misses allocate nothing.
+MISS = (False, 0, 0, 0)
+
+# gameplay mechanics.
+SPEED = 180
+JUMP_FORCE = 4.9
+GRAVITY = 10
+VELOCITY_SCALE = 60 # velocity is in pixels per 60th of a second.
+
+# fixed-step game logic.
+STEP = 1/120.0
+MAX_STEPS = 8 # most ticks to catch up on in one frame.
+HEALTH_TICKS = 15 # ticks between health checks.
+
+# prepared rooms kept for revisits.
+ROOM_CACHE_BYTES = 1 << 20
+ROOMDATA_BYTES = 2048 # rough fixed cost of a prepared room.
+
+# fewest patrolling entities worth stepping as numpy arrays.
+PATROL_ARRAY_MIN = 32
+
+# input buttons for one tick.
+B_LEFT = 1
+B_RIGHT = 2
+B_UP = 4
+B_DOWN = 8
+B_JUMP = 16
+
+
+class CollisionGrid(object):
+    """Row bitmasks for each tile class, for fast rectangle hit tests."""
+
+    width,height = 0,0
+
+    def __init__(self):
+        self.tilemap = []
+        self.rows = {} # class flags -> bitmask of matching cells per row.
+
+    def load(self, tilemap, w, h):
+        """Classify every tile of a flat w*h tile layer."""
+        self.tilemap = tilemap
+        self.width, self.height = w,h
+        rows = dict((flag,[0]*h) for flag,tiles in TILE_CLASSES)
+        for y in xrange(0,h):
+            for x in xrange(0,w):
+                flags = TILE_FLAGS[ord(tilemap[y*w+x])]
+                if flags:
+                    for flag,tiles in TILE_CLASSES:
+                        if flags & flag:
+                            rows[flag][y] |= 1 << x
+        self.rows = rows
+
+    def masks(self, check):
+        """Get row bitmasks for any combination of class flags."""
+        rows = self.rows.get(check)
+        if rows is None:
+            rows = [0] * self.height
+            for flag,tiles in TILE_CLASSES:
+                if check & flag:
+                    rows = [a|b for a,b in zip(rows, self.rows[flag])]
+            self.rows[check] = rows
+        return rows
+
+    def hitTest(self, x0, y0, x1, y1, check):
+        """Find the first tile in check classes touching a rectangle,
+        scanning rows from the top and cells from the left."""
+        ew,eh = self.width-1,self.height-1
+        tx0 = max(0,x0//TILE_W)
+        ty0 = max(0,y0//TILE_H)
+        tx1 = min(ew,x1//TILE_W)
+        ty1 = min(eh,y1//TILE_H)
+        if tx0 <= tx1:
+            span = (2 << tx1) - (1 << tx0) # bits tx0 to tx1.
+            rows = self.masks(check)
+            for ty in xrange(eh-ty1,eh-ty0+1): # invert Y axis.
+                bits = rows[ty] & span
+                if bits:
+                    tx = BIT_INDEX[bits & -bits] # lowest set bit.
+                    return True, tx, eh-ty, ord(self.tilemap[ty*self.width+tx])
+        return MISS
+
+
+class SpatialHash(object):
+    """Uniform grid of room entities for nearby-object queries.
+    Entities provide bounds() and call move() when those change."""
+
+    def __init__(self, cellsize=64):
+        self.cellsize = cellsize
+        self.cells = {} # (cx,cy) -> entities overlapping the cell.
+        self.places = {} # entity -> (insert order, cell range).
+        self.serial = 0
+
+    def clear(self):
+        self.cells.clear()
+        self.places.clear()
+
+    def span(self, x, y, w, h):
+        cs = self.cellsize
+        return int(x//cs), int(y//cs), int((x+w)//cs), int((y+h)//cs)
+
+    def insert(self, obj):
+        self.serial += 1
+        cells = self.span(*obj.bounds())
+        self.places[obj] = (self.serial, cells)
+        self.addCells(obj, cells)
+
+    def move(self, obj):
+        """Re-bucket an entity if it has moved into other cells."""
+        order, old = self.places[obj]
+        cells = self.span(*obj.bounds())
+        if cells != old:
+            self.removeCells(obj, old)
+            self.places[obj] = (order, cells)
+            self.addCells(obj, cells)
+
+    def addCells(self, obj, cells):
+        cx0,cy0,cx1,cy1 = cells
+        for cy in xrange(cy0,cy1+1):
+            for cx in xrange(cx0,cx1+1):
+                cell = self.cells.get((cx,cy))
+                if cell is None:
+                    self.cells[(cx,cy)] = [obj]
+                else:
+                    cell.append(obj) # emptied cells are kept for reuse.
+
+    def removeCells(self, obj, cells):
+        cx0,cy0,cx1,cy1 = cells
+        for cy in xrange(cy0,cy1+1):
+            for cx in xrange(cx0,cx1+1):
+                self.cells[(cx,cy)].remove(obj)
+
+    def query(self, x, y, w, h, attr):
+        """Get entities with a true attr in the cells touching a rectangle,
+        in insertion order. Callers still do an exact hit test."""
+        found = []
+        cx0,cy0,cx1,cy1 = self.span(x, y, w, h)
+        cells = self.cells
+        for cy in xrange(cy0,cy1+1):
+            for cx in xrange(cx0,cx1+1):
+                for obj in cells.get((cx,cy), ()):
+                    if getattr(obj, attr, 0) and obj not in found:
+                        found.append(obj)
+        if len(found) > 1:
+            found.sort(key=self.places.get) # by insert order.
+        return found
+
+
+class Patrols(object):
+    """Struct-of-arrays state for entities that move at a constant rate
+    and bounce between two limits, all stepped together once per tick.
+    Uses numpy arrays when numpy is installed and there are enough
+    entities to pay for the overhead, else plain lists.
+
+    Each entity reads its position from here through patrolled()
+    properties. Its spatial index entry is only moved when one of its
+    bounds edges (edge = a + k*pos) crosses into another cell.
+
+    Since the rate never changes size, position is a triangle wave of
+    time: evaluate(t) puts every entity where it would be t seconds
+    after it spawned, instead of stepping from the last tick. u0 is the
+    spawn position along the unfolded wave, 0 to 2*(hi-lo)."""
+
+    ARRAYS = ("pos", "last", "rate", "lo", "hi", "a0", "k0", "a1", "k1", "c0", "c1", "u0")
+
+    arrays = False # stepping numpy arrays.
+
+    def __init__(self, index):
+        self.index = index
+        self.objs = []
+        self.turning, self.moving = [], [] # reused by the list steps.
+        for name in self.ARRAYS:
+            setattr(self, name, [])
+
+    def __len__(self):
+        return len(self.objs)
+
+    def add(self, obj, pos, rate, lo, hi, edges):
+        """Add an entity; edges are a0,k0,a1,k1 for its bounds."""
+        obj.patrols, obj.slot = self, len(self.objs)
+        self.objs.append(obj)
+        if rate < 0:
+            u0 = 2*(hi-lo) - (pos-lo) # on the way back down.
+        else:
+            u0 = pos-lo
+        for name,value in zip(self.ARRAYS, (pos, pos, rate, lo, hi) + edges + (0, 0, u0)):
+            getattr(self, name).append(value)
+
+    def pack(self):
+        """Finish adding entities; switch to arrays if we can."""
+        cs = float(self.index.cellsize)
+        if numpy and len(self.objs) >= PATROL_ARRAY_MIN:
+            self.arrays = True
+            for name in self.ARRAYS:
+                setattr(self, name, numpy.array(getattr(self, name), dtype=float))
+            self.c0 = numpy.floor((self.a0 + self.k0*self.pos) / cs)
+            self.c1 = numpy.floor((self.a1 + self.k1*self.pos) / cs)
+        else:
+            self.c0 = [(a+k*p)//cs for a,k,p in zip(self.a0, self.k0, self.pos)]
+            self.c1 = [(a+k*p)//cs for a,k,p in zip(self.a1, self.k1, self.pos)]
+
+    def save(self):
+        """Remember positions from before a logic tick."""
+        self.last[:] = self.pos
+
+    def step(self, dt):
+        if not self.objs:
+            return
+        if self.arrays:
+            turned, moved = self.stepArrays(dt)
+        else:
+            turned, moved = self.stepLists(dt)
+        objs = self.objs
+        for i in turned:
+            objs[i].turned(self.rate[i])
+        for i in moved:
+            self.index.move(objs[i])
+
+    def stepArrays(self, dt):
+        pos, rate, lo, hi = self.pos, self.rate, self.lo, self.hi
+        pos += rate * dt
+        over = pos > hi
+        pos[over] = hi[over]
+        under = (pos < lo) & ~over
+        pos[under] = lo[under]
+        turned = over | under
+        rate[turned] = -rate[turned]
+        cs = float(self.index.cellsize)
+        c0 = numpy.floor((self.a0 + self.k0*pos) / cs)
+        c1 = numpy.floor((self.a1 + self.k1*pos) / cs)
+        moved = (c0 != self.c0) | (c1 != self.c1)
+        self.c0, self.c1 = c0, c1
+        return numpy.flatnonzero(turned), numpy.flatnonzero(moved)
+
+    def stepLists(self, dt):
+        pos, rate, lo, hi = self.pos, self.rate, self.lo, self.hi
+        a0, k0, a1, k1, c0, c1 = self.a0, self.k0, self.a1, self.k1, self.c0, self.c1
+        cs = float(self.index.cellsize)
+        turned, moved = self.turning, self.moving
+        del turned[:], moved[:]
+        for i in xrange(0,len(pos)):
+            p = pos[i] + rate[i] * dt
+            if p > hi[i]:
+                p = hi[i]
+                rate[i] = -rate[i]
+                turned.append(i)
+            elif p < lo[i]:
+                p = lo[i]
+                rate[i] = -rate[i]
+                turned.append(i)
+            pos[i] = p
+            e0, e1 = (a0[i] + k0[i]*p)//cs, (a1[i] + k1[i]*p)//cs
+            if e0 != c0[i] or e1 != c1[i]:
+                c0[i], c1[i] = e0, e1
+                moved.append(i)
+        return turned, moved
+
+    def evaluate(self, t):
+        """Put every entity where it is at time t; see above."""
+        if not self.objs:
+            return
+        if self.arrays:
+            turned, moved = self.evaluateArrays(t)
+        else:
+            turned, moved = self.evaluateLists(t)
+        objs = self.objs
+        for i in turned:
+            objs[i].turned(self.rate[i])
+        for i in moved:
+            self.index.move(objs[i])
+
+    def evaluateArrays(self, t):
+        lo, span, rate = self.lo, self.hi - self.lo, self.rate
+        period = 2*span
+        speed = numpy.abs(rate)
+        u = numpy.mod(self.u0 + speed*t, numpy.where(period > 0, period, 1))
+        self.pos[:] = lo + numpy.where(span > 0, numpy.minimum(u, period - u), 0)
+        rising = u < span
+        turned = (rising != (rate > 0)) & (span > 0)
+        rate[turned] = -rate[turned]
+        cs = float(self.index.cellsize)
+        c0 = numpy.floor((self.a0 + self.k0*self.pos) / cs)
+        c1 = numpy.floor((self.a1 + self.k1*self.pos) / cs)
+        moved = (c0 != self.c0) | (c1 != self.c1)
+        self.c0, self.c1 = c0, c1
+        return numpy.flatnonzero(turned), numpy.flatnonzero(moved)
+
+    def evaluateLists(self, t):
+        pos, rate, lo, hi, u0 = self.pos, self.rate, self.lo, self.hi, self.u0
+        a0, k0, a1, k1, c0, c1 = self.a0, self.k0, self.a1, self.k1, self.c0, self.c1
+        cs = float(self.index.cellsize)
+        turned, moved = self.turning, self.moving
+        del turned[:], moved[:]
+        for i in xrange(0,len(pos)):
+            span = hi[i] - lo[i]
+            if span > 0:
+                u = (u0[i] + abs(rate[i])*t) % (2*span)
+                p = lo[i] + min(u, 2*span - u)
+                if (u < span) != (rate[i] > 0):
+                    rate[i] = -rate[i]
+                    turned.append(i)
+            else:
+                p = lo[i]
+            pos[i] = p
+            e0, e1 = (a0[i] + k0[i]*p)//cs, (a1[i] + k1[i]*p)//cs
+            if e0 != c0[i] or e1 != c1[i]:
+                c0[i], c1[i] = e0, e1
+                moved.append(i)
+        return turned, moved
+
+
+def patrolled(name):
+    """Property for a coordinate kept in the room's Patrols arrays."""
+    def get(self):
+        return getattr(self.patrols, name)[self.slot]
+    def set(self, value):
+        getattr(self.patrols, name)[self.slot] = value
+    return property(get, set)
+
+
+class RoomData(object):
+    """Derived state for one room, built before the room is entered."""
+
+    view = None # renderer state, if any.
+
+    def __init__(self, tilemap, codes, w, h):
+        self.tilemap = tilemap # shared, original room data.
+        self.codes = codes # shared, original room data.
+        self.width, self.height = w,h
+        self.colmap = CollisionGrid() # derived collision map.
+        self.colmap.load(tilemap, w, h)
+        self.spawns = [] # factory, x, y, patrol limits for each code.
+        self.scans = {} # (code, dx, dy) -> cell each scan from a cell ends at.
+
+    def delete(self):
+        """Release renderer resources."""
+        if self.view:
+            self.view.delete()
+            self.view = None
+
+    def memory(self):
+        """Rough bytes held, for the room cache budget."""
+        size = ROOMDATA_BYTES + len(self.colmap.rows) * self.height * 16
+        size += len(self.spawns) * 64
+        size += len(self.scans) * self.width * self.height * 8
+        if self.view:
+            size += self.view.memory()
+        return size
+
+    def scanForCode(self, x, y, dx, dy, code):
+        """Scan the code layer in direction dx,dy for a value. Returns the
+        cell holding it, or the first cell past the edge of the map."""
+        cw,ch = self.width, self.height
+        top = TILE_H * ch - TILE_H # origin of top tile.
+        cx,cy = x//TILE_W, (top-y)//TILE_H # room coords to map cell.
+        if 0 <= cx < cw and 0 <= cy < ch and abs(dx) + abs(dy) == 1:
+            cx,cy = self.scanTable(code, dx, dy)[cy*cw+cx]
+        else:
+            codes = self.codes
+            while cx>=0 and cy >=0 and cx<cw and cy<ch:
+                if ord(codes[cy*cw+cx]) == code:
+                    break
+                cx += dx ; cy += dy
+        return (cx*TILE_W,top-cy*TILE_H) # map cell to room coords.
+
+    def scanTable(self, code, dx, dy):
+        """Get where a scan in one of the four directions ends from each
+        cell, working back from the far edge in a single pass."""
+        table = self.scans.get((code, dx, dy))
+        if table is None:
+            codes = self.codes
+            w,h = self.width, self.height
+            table = [None] * (w*h)
+            xs,ys = range(0,w), range(0,h)
+            if dx > 0: xs.reverse()
+            if dy > 0: ys.reverse()
+            for cy in ys:
+                for cx in xs:
+                    nx,ny = cx+dx, cy+dy
+                    if ord(codes[cy*w+cx]) == code:
+                        table[cy*w+cx] = (cx,cy)
+                    elif 0 <= nx < w and 0 <= ny < h:
+                        table[cy*w+cx] = table[ny*w+nx]
+                    else:
+                        table[cy*w+cx] = (nx,ny)
+            self.scans[(code, dx, dy)] = table
+        return table
+
+
+class RoomCache(object):
+    """Prepared rooms by position. Past the memory budget the least
+    recently used rooms are dropped, except the ones in use."""
+
+    def __init__(self, budget=ROOM_CACHE_BYTES):
+        self.budget = budget
+        self.entries = {} # (roomX, roomY) -> RoomData
+        self.order = [] # keys, least recently used first.
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Get a prepared room, or None."""
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.order.remove(key)
+            self.order.append(key)
+        return data
+
+    def put(self, key, data):
+        self.entries[key] = data
+        self.order.append(key)
+
+    def memory(self):
+        return sum([data.memory() for data in self.entries.values()])
+
+    def trim(self, keep=()):
+        """Drop rooms not in keep until the cache fits its budget."""
+        size = self.memory()
+        for key in self.order[:]:
+            if size <= self.budget:
+                break
+            if key not in keep:
+                data = self.entries.pop(key)
+                self.order.remove(key)
+                size -= data.memory()
+                data.delete()
+                self.evictions += 1
+
+    def clear(self):
+        for data in self.entries.values():
+            data.delete()
+        self.entries.clear()
+        del self.order[:]
+
+
+class Room(object):
+    """A tile-based game room."""
+
+    x,y = 0,0
+    mapwidth,mapheight = 1,1
+    tilewidth,tileheight = TILE_W,TILE_H
+    bounce = 0 # displacement due to falling damage.
+
+    def __init__(self, x, y, specials={}, codemap={}):
+        self.x, self.y = x,y
+        self.specials = specials
+        self.codemap = codemap
+        self.data = None # prepared state of the current room.
+        self.codes = [] # shared, original room data.
+        self.tilemap = [] # shared, original room data.
+        self.colmap = CollisionGrid() # derived collision map.
+        self.index = SpatialHash() # entities with bounds.
+        self.background = []
+        self.sprites = []
+        self.patrols = Patrols(self.index)
+        self.pools = {} # class -> released objects, kept for later spawns.
+        self.events = [] # names of sounds to play.
+
+    def prepare(self, room, codes, w, h):
+        """Derive collisions and spawns for a room without entering it.
+        Layers are flat w*h byte buffers, starting with the top row."""
+        data = RoomData(room, codes, w, h)
+        tw,th = self.tilewidth, self.tileheight
+        top = th * h - th # origin of top tile.
+        codemap = self.codemap
+        for y in xrange(0,h):
+            for x in xrange(0,w):
+                factory = codemap.get(ord(codes[y*w+x]))
+                if factory:
+                    px,py = x*tw, top-y*th
+                    limits = getattr(factory, "limits", None)
+                    if limits:
+                        limits = limits(data, px, py)
+                    data.spawns.append((factory, px, py, limits))
+        return data
+
+    def load(self, data, objs):
+        """Enter a prepared room; spawn sprites."""
+        self.data = data
+        del self.background[:], self.sprites[:]
+        self.index.clear()
+        self.patrols = Patrols(self.index)
+        self.mapwidth, self.mapheight = data.width, data.height
+        self.colmap = data.colmap
+        self.tilemap = data.tilemap
+        self.codes = data.codes # must set before calling factories.
+        for factory,x,y,limits in data.spawns:
+            objs.append(self.spawn(factory, x, y, limits))
+        self.patrols.pack()
+        for obj in self.background + self.sprites:
+            if (getattr(obj, "climbable", 0) or getattr(obj, "supports", 0)
+                    or getattr(obj, "hurtful", 0)):
+                self.index.insert(obj)
+
+    def spawn(self, factory, x, y, limits=None):
+        """Make an object for a map code, reusing a released one if we can."""
+        if limits is None:
+            args = (x, y, self)
+        else:
+            args = (x, y, self, limits)
+        pool = self.pools.get(factory)
+        if not pool:
+            return factory(*args)
+        obj = pool.pop()
+        view = obj.view
+        obj.__dict__.clear() # as good as new, but keep what draws it.
+        obj.view = view
+        obj.__init__(*args)
+        return obj
+
+    def release(self, objs):
+        """Keep objects from a room we are leaving for later spawns.
+        Pools grow to the most of each class any one room holds."""
+        for obj in objs:
+            self.pools.setdefault(obj.__class__, []).append(obj)
+
+    def hitTest(self, x0, y0, x1, y1, check):
+        """Hit-test a rectangle against map tiles in check classes."""
+        return self.colmap.hitTest(x0, y0, x1, y1, check)
+
+    def tileTest(self, x, y, w, h, check):
+        """Hit-test against the room tile layer."""
+        return self.colmap.hitTest(x, y, x+w, y+h, check)
+
+    def scanForCode(self, x, y, dx, dy, code):
+        """Scan the code layer in direction dx,dy for a value."""
+        return self.data.scanForCode(x, y, dx, dy, code)
+
+
+class Actor(object):
+    """Entity with a position, a current frame and tile collisions."""
+
+    climbable = supports = hurtful = False
+    width,height = 32,32
+    frame = 0 # index into the frames drawn for this actor.
+    view = None # renderer state, if any.
+    slot = None # index in the room's Patrols, if it patrols.
+
+    def __init__(self, x, y):
+        self.x, self.y = x,y
+        self.lastx, self.lasty = x,y
+
+    def saveState(self):
+        """Remember the position from before a logic tick."""
+        self.lastx, self.lasty = self.x, self.y
+
+    def setFrame(self, index):
+        self.frame = index
+
+    def bounds(self):
+        return self.x, self.y, self.width, self.height
+
+    def hitTest(self, x, y, w, h):
+        """Conservative hit test for player collisions."""
+        mx,my,mw,mh = self.x+4,self.y+4,self.width-8,self.height-8
+        return x<mx+mw and x+w>mx and y<my+mh and y+h>my
+
+
+class Player(Actor):
+
+    width,height = 32,48
+    velocity = 0
+    anim = 0
+    defecit = 0
+    health = 100
+    support = None # sprite we are standing on.
+
+    def __init__(self, x, y, room):
+        self.room = room
+        Actor.__init__(self, x, y)
+
+    def move(self, dx, dy, jump, dt):
+        """Process player input."""
+        w,h = 32,32
+        ox,rw,rh = 2,w-4-1,h-1 # smaller collision rect.
+
+        oldx,oldy = int(self.x),int(self.y)
+        moved = False
+
+        # issues:
+        # - when falling onto a climbable tile, the player falls inside
+        #   the tile by whatever velocity they have at impact.
+        # - bouncing at tops of ladders.
+        # - climbable means both up and down at once.
+
+        # test for climbable tiles or sprites in contact with the player.
+        # note we do not look below the player's feet here, we do that later.
+        # hit test the room's collision grid directly; this runs every tick.
+        hitTest = self.room.colmap.hitTest
+        qx,qy = oldx + ox, oldy
+        canClimb = hitTest(qx, qy-1, qx+rw, qy+rh, T_CLIMBABLE)[0]
+        if not canClimb:
+            # test only background sprites; ropes.
+            for obj in self.room.index.query(qx, qy, rw, rh, "climbable"):
+                if obj.hitTest(qx, qy, rw, rh):
+                    canClimb = True
+                    break
+
+        # accumulate move adjustments until we move at least one pixel,
+        # then hittest the area covered by the integer movement.
+        adjx = self.x + SPEED*dx
+        newx = int(adjx)
+        if newx > oldx: # moving right.
+            hit,hx,hy,tc = hitTest(oldx+ox+rw, oldy, newx+ox+rw, oldy+rh, T_SOLID)
+            self.x = hx*TILE_W-(rw+1)-ox if hit else adjx
+            self.anim = 0
+            moved = True
+        elif newx < oldx: # moving left.
+            hit,hx,hy,tc = hitTest(newx+ox, oldy, oldx+ox, oldy+rh, T_SOLID)
+            self.x = (hx+1)*TILE_W-ox if hit else adjx
+            self.anim = 1
+            moved = True
+        else:
+            self.x = adjx # accumulate movement.
+
+        # determine vertical movement.
+        support = self.support
+        climbed = False
+        adjy = self.y
+        if canClimb:
+            # allow the player to climb.
+            if dy != 0:
+                adjy = self.y + SPEED*dy
+                self.anim = 2
+                moved = True
+                climbed = True
+                self.stopFalling() # stop jumping or falling.
+            else:
+                # allow jumping but not falling.
+                self.velocity += dt * -GRAVITY
+                if self.velocity > 0:
+                    adjy = self.y + self.velocity * dt * VELOCITY_SCALE
+                else:
+                    self.stopFalling()
+        else:
+            # apply gravity.
+            self.velocity += dt * -GRAVITY
+            adjy = self.y + self.velocity * dt * VELOCITY_SCALE
+
+        # apply vertical movement unless on a support sprite.
+        supported = canClimb
+        newy = int(adjy)
+        newx = int(self.x) + ox
+        if newy > oldy: # moving up.
+            support = None # climbed off support.
+            hit,hx,hy,tc = hitTest(newx, oldy+rh, newx+rw, newy+rh, T_SOLID)
+            if hit:
+                self.y = hy*TILE_H-(rh+1)
+                if self.velocity > 0:
+                    self.velocity = 0 # stop upward velocity.
+            else:
+                self.y = adjy
+        elif newy < oldy: # moving down.
+            support = None # moved off support.
+            hit,hx,hy,tc = hitTest(newx, newy, newx+rw, oldy, T_SOLID)
+            if hit:
+                self.y = (hy+1)*TILE_H
+                supported = True
+                self.stopFalling()
+            else:
+                # would fall: check for a supporting sprite below us.
+                qh = oldy - newy
+                for obj in self.room.index.query(newx, newy, rw, qh, "supports"):
+                    if obj.hitTest(newx, newy, rw, qh):
+                        if support is None or obj.y + obj.level > support.y + support.level:
+                            support = obj
+                if support is None:
+                    # no support: free fall.
+                    self.y = adjy
+        else:
+            self.y = adjy # accumulate movement.
+
+        if support is not None:
+            supported = True
+
+        # check for jump input if standing on something.
+        # avoid jumping while climbing since it spam-jumps every frame!
+        # velocity <=0 avoids spam-jumping when jumping up ladders.
+        # TODO: still spam-jumps when something is above your head.
+        if jump and supported and not climbed and self.velocity <= 0:
+            self.velocity = JUMP_FORCE
+            if support is not None:
+                func = getattr(support, "actorJump", None)
+                if func: func(self)
+            self.room.events.append("jump")
+            support = None # jumped off support.
+
+        # notify supports if our support has changed.
+        if support is not self.support:
+            #print "CHANGED SUPPORT"
+            # notify our old support, if any.
+            func = getattr(self.support, "lostActor", None)
+            if func: func(self)
+            # notify our new support.
+            self.support = support
+            func = getattr(support, "gainActor", None)
+            if func: func(self)
+
+        # this must deal with actor position and velocity.
+        if support is not None:
+            support.supportActor(self)
+
+        if self.velocity != 0:
+            # show a jump/fall frame.
+            self.setFrame(self.anim + 6)
+        elif moved and supported:
+            # show animated walk or climb.
+            self.setFrame(self.anim)
+        else:
+            # show an idle frame.
+            self.setFrame(self.anim + 3)
+
+    def stopFalling(self):
+        if self.velocity < -8:
+            # take falling damage.
+            damage = (-self.velocity-8)*3
+            #print "DAMAGE", damage, self.velocity
+            self.defecit += damage
+            self.room.bounce = min(int(damage/2),4) # limit to 4.
+        self.velocity = 0
+
+    def update(self, dt):
+        pass
+
+    def checkDamage(self):
+        # conservative collision rect for the player.
+        qx,qy,rw,rh = int(self.x) + 6, int(self.y), 32-12, 28
+        damage = self.room.colmap.hitTest(qx, qy, qx+rw, qy+rh, T_DAMAGE)[0]
+        if not damage:
+            # hit-test all enemy sprites.
+            for obj in self.room.index.query(qx, qy, rw, rh, "hurtful"):
+                if obj.hitTest(qx, qy, rw, rh):
+                    damage = True
+                    break
+        if damage:
+            self.defecit += 1
+
+
+class Torch(Actor):
+    """Animated torch fixture."""
+    def __init__(self, x, y, room):
+        Actor.__init__(self, x, y)
+        room.background.append(self)
+    def update(self, dt):
+        pass
+
+
+class DropRope(object):
+    """Rope that moves up and down."""
+
+    rate = SPEED*2/3
+    LEFT = 14 # position inside the tile.
+    WIDTH = 8 # width of the rope image.
+    climbable = True
+    view = None # renderer state, if any.
+    height = patrolled("pos")
+    lastheight = patrolled("last")
+
+    def __init__(self, x, y, room, limits=None):
+        self.limit, = limits or self.limits(room, x, y)
+        y += TILE_H # start from top edge of tile.
+        self.x, self.y = self.LEFT + x, y
+        self.width = self.WIDTH
+        # bounds run from y-height up to y.
+        room.patrols.add(self, 0, self.rate, 0, self.limit, (y, -1, y, 0))
+        self.room = room
+        room.background.append(self)
+
+    @classmethod
+    def limits(cls, room, x, y):
+        """Find the longest drop, from the end-of-rope code below."""
+        ex,ey = room.scanForCode(x,y,0,1,C_ENDROPE)
+        return (y + TILE_H - ey,)
+
+    def turned(self, rate):
+        pass
+
+    def bounds(self):
+        return self.x, self.y-self.height, self.width, self.height
+
+    def hitTest(self, x, y, w, h):
+        """Exact hit test with fix for reversed y coordinate"""
+        mx,my,mw,mh = self.x,self.y-self.height,self.width,self.height
+        return x<mx+mw and x+w>mx and y<my+mh and y+h>my
+
+
+class SpringBoard(Actor):
+    """A bouncy platform on a spring."""
+
+    supports = True
+    maxLevel = 24
+    level = maxLevel # support height level.
+    kinetic = 0
+
+    def __init__(self, x, y, room):
+        Actor.__init__(self, x, y)
+        room.background.append(self)
+
+    def update(self, dt):
+        """Drain away kinetic energy."""
+        if self.kinetic > 0:
+            self.kinetic -= 5*dt
+            if self.kinetic < 0: self.kinetic = 0
+        steps = min(int(self.kinetic), 3) # limit 3
+        self.setFrame(steps)
+        self.level = self.maxLevel - steps * 4
+        #print "KSL", self.kinetic, steps, self.level
+
+    def supportActor(self, other):
+        """Reposition the actor and clear velocity."""
+        other.y = self.y + self.level
+        other.velocity = 0
+
+    def actorJump(self, other):
+        """Boost the jump using our kinetic energy."""
+        other.velocity += self.kinetic
+        self.kinetic = 0
+        self.update(0)
+
+    def gainActor(self, other):
+        """Notify that an actor has landed on us."""
+        if other.velocity < 0:
+            force = int(-other.velocity-2)
+            self.kinetic += force
+            self.update(0)
+            other.velocity = 0 # soak up velocity.
+
+    def bounds(self):
+        return self.x, self.y, self.width, self.maxLevel
+
+    def hitTest(self, x, y, w, h):
+        """Hit-test against the current spring level."""
+        mx,my,mw,mh = self.x+8,self.y,self.width-12,self.level
+        return x<mx+mw and x+w>mx and y<my+mh and y+h>my
+
+
+class HorzEnemy(Actor):
+    """Enemy that moves horizontally between blocker codes."""
+
+    rate = -SPEED*2/3 # initially moving left.
+    x = patrolled("pos")
+    lastx = patrolled("last")
+
+    def __init__(self, x, y, room, limits=None):
+        self.left, self.right = limits or self.limits(room, x, y)
+        room.patrols.add(self, x, self.rate, self.left, self.right,
+                         (0, 1, self.width, 1))
+        Actor.__init__(self, x, y)
+        self.room = room
+        room.sprites.append(self)
+
+    @classmethod
+    def limits(cls, room, x, y):
+        """Find the patrol range between the blocker codes either side."""
+        sx,sy = room.scanForCode(x, y, -1, 0, C_BLOCKER)
+        ex,ey = room.scanForCode(x, y, 1, 0, C_BLOCKER)
+        # adjust to avoid entering the blocker tiles.
+        return sx + TILE_W, ex - TILE_W
+
+    def turned(self, rate):
+        """Face the way we now move."""
+        if rate < 0:
+            self.setFrame(0)
+        else:
+            self.setFrame(1)
+
+
+class Crawler(HorzEnemy):
+    """Crawls along the ground."""
+    hurtful = True
+
+
+class Bat(HorzEnemy):
+    """Flies left and right."""
+    hurtful = True
+
+
+class Spider(Actor):
+    """Moves up and down on a sliver of web."""
+    rate = SPEED/3 # initially moving down.
+    LEFT = 14 # position of web inside the tile.
+    hurtful = True
+
+    y = patrolled("pos")
+    lasty = patrolled("last")
+
+    def __init__(self, x, y, room, limits=None):
+        self.top, self.bottom = limits or self.limits(room, x, y)
+        y = self.top # start at the top.
+        room.patrols.add(self, y, self.rate, self.bottom, self.top,
+                         (0, 1, self.height, 1))
+        Actor.__init__(self, x, y)
+        self.room = room
+        room.sprites.append(self)
+
+    @classmethod
+    def limits(cls, room, x, y):
+        """Hang from the web top code above."""
+        sx,sy = room.scanForCode(x, y, 0, -1, C_SPIDERTOP)
+        return sy, y
+
+    def turned(self, rate):
+        pass
+
+
+codemap = {
+    C_TORCH:    Torch,
+    C_ROPE:     DropRope,
+    C_SPRING:   SpringBoard,
+    C_CRAWLER:  Crawler,
+    C_BAT:      Bat,
+    C_SPIDER:   Spider,
+}
+
+
+class Simulation(object):
+    """Game state stepped in fixed ticks, without any window."""
+
+    def __init__(self, world, codemap=codemap, blackout=0, cache=ROOM_CACHE_BYTES):
+        """blackout hides the room for that many seconds on a room change.
+        cache is the memory budget in bytes for prepared rooms."""
+        self.world = world
+        self.blackout = blackout
+        self.hidden = 0 # ticks left until the room is shown.
+        self.room = Room(0, 32, codemap=codemap)
+        self.prepared = RoomCache(cache)
+        self.prefetching = [] # neighbouring rooms still to prepare.
+        self.roomX, self.roomY = 8,8
+        self.inRoom = True
+        self.playing = False
+        self.buttons = 0 # input held for the coming ticks.
+        self.recording = None # InputLog of the played ticks, if any.
+        self.replay = None # InputLog overriding buttons, if any.
+        self.clocked = False # place patrols by the time, not by stepping them.
+        self.lag = 0 # real time not yet simulated.
+        self.ticks = 0
+        self.player = Player(10*32, 1*32, self.room)
+        self.objs = [self.player]
+        self.active = [self.player] # objects updated one by one.
+        self.held = [] # an old room's object the player still stands on.
+
+    def update(self, dt):
+        """Run fixed logic ticks to catch up with real time."""
+        del self.room.events[:]
+        self.lag += dt
+        steps = 0
+        while self.lag >= STEP:
+            if steps == MAX_STEPS:
+                self.lag = 0 # too far behind; drop the backlog.
+                break
+            self.tick(STEP)
+            self.lag -= STEP
+            steps += 1
+        if self.prefetching:
+            # use idle frame time to prepare one neighbouring room.
+            self.roomData(*self.prefetching.pop())
+            self.lap("room")
+
+    def lap(self, phase):
+        """Mark the end of a phase of the frame; see profiler.py."""
+        pass
+
+    def note(self, kind, detail=""):
+        """Note an event that may slow down the frame; see hitches.py."""
+        pass
+
+    def tick(self, dt):
+        """Advance the game logic by one fixed step."""
+        self.ticks += 1
+        if self.ticks % HEALTH_TICKS == 0:
+            self.checkHealth(dt)
+            self.lap("health")
+        if self.hidden:
+            self.hidden -= 1
+            if not self.hidden:
+                self.inRoom = True
+        if self.inRoom and self.playing:
+            for s in self.active:
+                s.saveState()
+            self.room.patrols.save()
+
+            # apply player movement.
+            buttons = self.buttons
+            if self.replay is not None:
+                buttons = self.replay.next()
+            if self.recording is not None:
+                self.recording.add(buttons)
+            dx,dy = 0,0
+            if buttons & B_LEFT:
+                dx = -dt
+            if buttons & B_RIGHT:
+                dx = dt
+            if buttons & B_UP:
+                dy = dt
+            if buttons & B_DOWN:
+                dy = -dt
+            jump = buttons & B_JUMP
+            self.lap("input")
+            self.player.move(dx, dy, jump, dt)
+            self.lap("move")
+
+            # change room when the player reaches the edge.
+            x,y = self.player.x, self.player.y
+            if x < 0:
+                self.player.x = ROOMWIDTH-TILE_W
+                self.changeRoom(-1,0)
+            elif x > ROOMWIDTH-TILE_W:
+                self.player.x = 0
+                self.changeRoom(1,0)
+            if y < 0:
+                self.player.y = ROOMHEIGHT-TILE_H
+                self.changeRoom(0,1)
+            elif y > ROOMHEIGHT-TILE_H:
+                self.player.y = 0
+                self.changeRoom(0,-1)
+            self.lap("room")
+
+            # update all objects; patrolling ones all at once.
+            for s in self.active:
+                s.update(dt)
+            if self.clocked:
+                self.room.patrols.evaluate(self.ticks * STEP)
+            else:
+                self.room.patrols.step(dt)
+            self.lap("objects")
+
+    def checkHealth(self, dt):
+        if self.room.bounce > 0:
+            self.room.bounce -= 1
+        if self.player.health > 0:
+            self.player.checkDamage()
+            if self.player.defecit > 0:
+                self.player.defecit -= 1
+                self.player.health -= 1
+                self.room.events.append("ouch")
+
+    def startGame(self):
+        # start from a known state so input logs replay exactly.
+        self.ticks, self.lag = 0, 0
+        log = self.replay
+        if log is not None:
+            log.rewind()
+            self.roomX, self.roomY, self.blackout = log.roomX, log.roomY, log.blackout
+            self.clocked = log.clocked
+        if self.recording is not None:
+            log = self.recording
+            log.roomX, log.roomY, log.blackout = self.roomX, self.roomY, self.blackout
+            log.clocked = self.clocked
+        self.changeRoom(0,0)
+        self.player.x, self.player.y = 8*32, 1*32
+        self.player.saveState()
+        self.playing = True
+
+    def changeRoom(self,x,y):
+        """Move to a neighbouring room."""
+        self.player.saveState() # do not interpolate across the edge.
+        self.roomX = max(self.roomX + x, 0)
+        self.roomY = max(self.roomY + y, 0)
+        self.note("room", "%d,%d" % (self.roomX, self.roomY))
+        self.loadRoom(self.roomX, self.roomY)
+        if self.blackout:
+            self.inRoom = False
+            self.hidden = max(int(self.blackout / STEP), 1)
+
+    def roomData(self, roomX, roomY):
+        """Get prepared state for a room, preparing it if necessary."""
+        data = self.prepared.get((roomX,roomY))
+        if data is None:
+            self.note("prepare", "%d,%d" % (roomX, roomY))
+            w = self.world
+            data = self.room.prepare(w.layer(roomX, roomY, 0), w.layer(roomX, roomY, 1),
+                                     w.layerwidth, w.layerheight)
+            self.prepared.put((roomX,roomY), data)
+        return data
+
+    def loadRoom(self, roomX, roomY):
+        # reuse the old room's objects. The player still calls back to one
+        # it stands on, so that waits for a room change after it steps off.
+        player = self.player
+        old = [obj for obj in self.objs if obj is not player] + self.held
+        self.held = [obj for obj in old if obj is player.support]
+        self.room.release([obj for obj in old if obj is not player.support])
+        self.objs = [player]
+        self.room.load(self.roomData(roomX, roomY), self.objs)
+        self.active = [obj for obj in self.objs if obj.slot is None]
+        if self.clocked:
+            # the room kept going while we were away.
+            self.room.patrols.evaluate(self.ticks * STEP)
+            self.room.patrols.save()
+        # always keep this room and its neighbours; prepare those later.
+        w = self.world
+        near = [(roomX+dx,roomY+dy) for dx,dy in ((-1,0),(1,0),(0,-1),(0,1))]
+        near = [(x,y) for x,y in near if 0 <= x < w.width and 0 <= y < w.height]
+        self.prepared.trim([(roomX,roomY)] + near)
+        self.prefetching = [key for key in near if key not in self.prepared]
+
+
+class InputLog(object):
+    """Run-length record of the buttons held on each played tick, with
+    the settings needed to replay it."""
+
+    def __init__(self, roomX=8, roomY=8, blackout=0, clocked=False):
+        self.roomX, self.roomY = roomX, roomY
+        self.blackout = blackout
+        self.clocked = clocked
+        self.runs = [] # [buttons, ticks] pairs.
+        self.rewind()
+
+    def __len__(self):
+        return sum([ticks for buttons,ticks in self.runs])
+
+    def rewind(self):
+        self.run, self.count = 0, 0 # replay position.
+
+    def add(self, buttons):
+        runs = self.runs
+        if runs and runs[-1][0] == buttons:
+            runs[-1][1] += 1
+        else:
+            runs.append([buttons, 1])
+
+    def next(self):
+        """Get the buttons for the next replayed tick; none at the end."""
+        runs = self.runs
+        while self.run < len(runs):
+            buttons, ticks = runs[self.run]
+            if self.count < ticks:
+                self.count += 1
+                return buttons
+            self.run, self.count = self.run + 1, 0
+        return 0
+
+    def done(self):
+        runs = self.runs
+        return self.run >= len(runs) or (self.run == len(runs)-1
+                                         and self.count >= runs[-1][1])
+
+    def save(self, filename):
+        f = open(filename, "w")
+        try:
+            f.write("room %d,%d\n" % (self.roomX, self.roomY))
+            f.write("blackout %g\n" % self.blackout)
+            if self.clocked:
+                f.write("clocked\n")
+            f.write(formatScript(self.runs) + "\n")
+        finally:
+            f.close()
+
+def loadInputLog(filename):
+    """Read an input log written by InputLog.save."""
+    log = InputLog()
+    for line in open(filename):
+        line = line.strip()
+        if line.startswith("room "):
+            log.roomX, log.roomY = [int(v) for v in line[5:].split(",")]
+        elif line.startswith("blackout "):
+            log.blackout = float(line[9:])
+        elif line == "clocked":
+            log.clocked = True
+        elif line:
+            log.runs.extend([list(run) for run in parseScript(line)])
+    return log
+
+
+# button names for input scripts, in bit order.
+BUTTONS = (("left", B_LEFT), ("right", B_RIGHT), ("up", B_UP),
+           ("down", B_DOWN), ("jump", B_JUMP))
+BUTTON_BITS = dict(BUTTONS + (("none", 0),))
+
+def parseScript(text):
+    """Parse scripted input like "right:120,right+jump:10" into a list
+    of (buttons, ticks) pairs."""
+    script = []
+    for step in text.split(","):
+        names, count = step.split(":")
+        buttons = 0
+        for name in names.split("+"):
+            buttons |= BUTTON_BITS[name.strip()]
+        script.append((buttons, int(count)))
+    return script
+
+def formatScript(script):
+    """Format (buttons, ticks) pairs as a script for parseScript."""
+    steps = []
+    for buttons, count in script:
+        names = [name for name,bit in BUTTONS if buttons & bit] or ["none"]
+        steps.append("%s:%d" % ("+".join(names), count))
+    return ",".join(steps)
+
+def run(sim, script, ticks):
+    """Step a simulation for a number of ticks, cycling through a script
+    of (buttons, ticks) pairs."""
+    done = 0
+    while done < ticks:
+        for buttons, count in script:
+            sim.buttons = buttons
+            for i in xrange(0, min(count, ticks - done)):
+                sim.update(STEP)
+            done += count
+            if done >= ticks:
+                break
+
+def loadWorld():
+    """Open the world file that ships with the game."""
+    home = os.path.dirname(os.path.abspath(__file__))
+    return world.World(open(os.path.join(home, "data", "world.bin"), "rb"))
+
+def main():
+    import optparse, time
+    parser = optparse.OptionParser()
+    parser.add_option("--ticks", type="int", default=120*60,
+                      help="number of logic ticks to run")
+    parser.add_option("--input", default="right:240,left:240,right+jump:60,up:60",
+                      help="input script, repeated until the ticks run out")
+    parser.add_option("--room", default="8,8", help="starting room x,y")
+    parser.add_option("--replay", metavar="FILE",
+                      help="replay an input log recorded by the game instead")
+    parser.add_option("--clocked", action="store_true",
+                      help="place patrolling enemies by the time instead of stepping them")
+    options, args = parser.parse_args()
+    sim = Simulation(loadWorld())
+    sim.clocked = options.clocked
+    sim.roomX, sim.roomY = [int(v) for v in options.room.split(",")]
+    if options.replay:
+        sim.replay = loadInputLog(options.replay)
+    sim.startGame()
+    start = time.time()
+    if sim.replay is not None:
+        while not sim.replay.done():
+            sim.update(STEP)
+    else:
+        run(sim, parseScript(options.input), options.ticks)
+    elapsed = max(time.time() - start, 1e-6)
+    print "%d ticks in %.2fs: %.0f ticks/s; room %d:%d at %d,%d, health %d" % (
+        sim.ticks, elapsed, sim.ticks / elapsed, sim.roomX, sim.roomY,
+        sim.player.x, sim.player.y, sim.player.health)
+    cache = sim.prepared
+    print "room cache: %d rooms, %d hits, %d misses, %d evicted" % (
+        len(cache), cache.hits, cache.misses, cache.evictions)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Packed binary world maps.
+
+A world file holds every room layer as raw uint8 cells so it can be
+memory-mapped at startup instead of parsed. Layout, little-endian:
+
+    header  magic "BNFW", version, rooms wide, rooms high,
+            layer width, layer height, layers per room (u16 each)
+    index   u32 file offset of each layer, room by room
+    data    layer cells, row by row from the top of the room
+
+Since version 2, identical layers are stored once and share an offset,
+and layers of nothing but zeros are not stored at all: their offset is
+0, where no layer can be. Most rooms have an empty code layer and many
+repeat another's, so large worlds stay small, and finding a layer is
+still one index lookup. Version 1 files read the same way.
+"""
+
+import mmap, struct
+
+MAGIC = "BNFW"
+VERSION = 2
+VERSIONS = (1, 2) # versions we can read.
+HEADER = struct.Struct("<4s6H")
+OFFSET = struct.Struct("<I")
+
+
+class World(object):
+    """A memory-mapped world file."""
+
+    width,height = 0,0 # size in rooms.
+    layerwidth,layerheight = 0,0 # size of each layer in cells.
+    layers = 0 # layers per room.
+
+    def __init__(self, file=None):
+        self.data = None
+        if file:
+            self.load(file)
+
+    def load(self, file):
+        """Map a world file; the file object can be closed afterwards."""
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.width, self.height, self.layerwidth,
+            self.layerheight, self.layers) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version not in VERSIONS:
+            raise ValueError("not a version %d world file" % VERSION)
+        self.data = data
+        self.empty = buffer("\0" * (self.layerwidth * self.layerheight))
+
+    def layer(self, roomX, roomY, n):
+        """Get a zero-copy buffer over one layer of a room."""
+        i = (roomY * self.width + roomX) * self.layers + n
+        offset = OFFSET.unpack_from(self.data, HEADER.size + i*OFFSET.size)[0]
+        if not offset:
+            return self.empty # shared by every empty layer.
+        return buffer(self.data, offset, self.layerwidth * self.layerheight)
+
+
+def save(filename, width, height, layers):
+    """Write a world file from nested-list layers in rooms.py order,
+    storing each distinct layer once and empty layers not at all."""
+    lh = len(layers[0])
+    lw = len(layers[0][0])
+    per = len(layers) // (width * height)
+    offset = HEADER.size + OFFSET.size * len(layers)
+    empty = "\0" * (lw * lh)
+    offsets = {empty: 0} # layer cells -> where they are stored.
+    index, cells = [], []
+    for layer in layers:
+        layer = "".join([chr(v) for row in layer for v in row])
+        if layer not in offsets:
+            offsets[layer] = offset
+            cells.append(layer)
+            offset += lw * lh
+        index.append(OFFSET.pack(offsets[layer]))
+    f = open(filename, "wb")
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, width, height, lw, lh, per))
+        f.write("".join(index))
+        f.write("".join(cells))
+    finally:
+        f.close()